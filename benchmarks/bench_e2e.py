@@ -0,0 +1,302 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""End-to-end throughput, latency and memory of TeleRaid.
+
+Starts start_teleraid.py with a generated config against the fake
+Telegram Bot API, posts synthetic webhooks for a while and waits until all
+raids are notified. Reports the accepted event rate, the latency from a
+raid's webhook to its completed notification and the resident memory of
+the TeleRaid process, then compares them with the baseline of the engine
+in benchmarks/baseline.json.
+
+    python -m benchmarks.bench_e2e [--rate 20] [--duration 30] [--chats 3]
+        [--save-baseline]
+"""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import urllib3
+
+from .fake_telegram import FakeTelegram, serve
+from .loadgen import LoadGenerator
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE = os.path.join(ROOT, 'benchmarks', 'baseline.json')
+
+# Makes start_teleraid.py import the generated config package first
+BOOTSTRAP = ('import runpy, sys; sys.path.insert(0, sys.argv[1]); '
+             'runpy.run_path("start_teleraid.py", run_name="__main__")')
+
+# Relative change of a result that counts as a regression
+TOLERANCE = {
+    'accepted_rate': -0.1,
+    'notify_rate': -0.1,
+    'latency_p50': 0.25,
+    'latency_p99': 0.25,
+    'rss_peak_mb': 0.1
+}
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100.0 * len(values))))]
+
+
+def rss_mb(pid):
+    # Linux only, other systems report no memory figures
+    try:
+        with open('/proc/{}/status'.format(pid)) as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024.0
+    except (IOError, OSError):
+        pass
+    return None
+
+
+def write_config(directory, args, api_url):
+    chats = [{'chat_id': -1001000000000 - i} for i in range(args.chats)]
+    config = {
+        'bot_token': '123456:benchmark',
+        'chat_id': chats[0]['chat_id'],
+        'chats': chats,
+        'host': '127.0.0.1',
+        'port': args.port,
+        'telegram_api_url': api_url,
+        'queue_size': args.queue_size,
+        'rate_limit_global': args.rate_limit_global,
+        'rate_limit_chat': args.rate_limit_chat,
+        'store': None,
+        'engine': args.engine,
+        'shards': args.shards,
+        'notification_format': args.format,
+        'telegram_webhook_url': ('http://127.0.0.1:{}'.format(args.port)
+                                 if args.telegram_webhook else None),
+        'locale': 'en'
+    }
+    os.mkdir(os.path.join(directory, 'config'))
+    open(os.path.join(directory, 'config', '__init__.py'), 'w').close()
+    with open(os.path.join(directory, 'config', 'config.py'), 'w') as f:
+        f.write('config = {!r}\n'.format(config))
+
+
+def wait_until(condition, timeout, interval=0.2):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if condition():
+            return True
+        time.sleep(interval)
+    return False
+
+
+def run(args):
+    telegram = FakeTelegram(args.latency, args.flood_rate,
+                            vote_rate=args.vote_rate, seed=42)
+    server = serve(telegram)
+    directory = tempfile.mkdtemp(prefix='teleraid-bench-')
+    write_config(directory, args, 'http://127.0.0.1:{}'.format(
+        server.server_port))
+    base_url = 'http://127.0.0.1:{}'.format(args.port)
+    http = urllib3.PoolManager(retries=False)
+
+    def reachable():
+        try:
+            response = http.request('GET', base_url + '/stats')
+        except Exception:
+            return False
+        # A front-end reports unreachable shards as null
+        return response.status == 200 and None not in (json.loads(
+            response.data.decode('utf-8'))['teleraid'].get('shards') or ())
+
+    log = open(os.path.join(directory, 'teleraid.log'), 'w')
+    process = subprocess.Popen([args.python, '-c', BOOTSTRAP, directory],
+                               cwd=ROOT, stdout=log, stderr=log)
+    try:
+        if not wait_until(reachable, 30):
+            raise RuntimeError("TeleRaid did not start, see {}".format(
+                log.name))
+
+        samples = []
+        sampling = threading.Event()
+
+        def sample():
+            while not sampling.wait(1.0):
+                samples.append(rss_mb(process.pid))
+
+        rss_start = rss_mb(process.pid)
+        sampler = threading.Thread(target=sample)
+        sampler.daemon = True
+        sampler.start()
+
+        generator = LoadGenerator(base_url + '/', args.rate, args.batch,
+                                  seed=42)
+        started = time.time()
+        generator.run(args.duration)
+        load_seconds = time.time() - started
+
+        wait_until(lambda: len(telegram.delivered) >=
+                   len(generator.raids) * args.chats, args.drain)
+        notify_seconds = time.time() - started
+        sampling.set()
+        rss_end = rss_mb(process.pid)
+        stats = json.loads(http.request('GET', base_url + '/stats').data
+                           .decode('utf-8'))
+    finally:
+        process.terminate()
+        process.wait()
+        log.close()
+        server.shutdown()
+        if process.returncode not in (0, -15) or args.keep:
+            print("TeleRaid log kept in {}".format(log.name))
+        else:
+            shutil.rmtree(directory)
+
+    latencies = [at - generator.raids[location]
+                 for at, location in telegram.delivered
+                 if location in generator.raids]
+    peak = max([s for s in samples if s is not None] or [rss_end or 0])
+    return {
+        'scenario': scenario(args),
+        'events_sent': generator.sent,
+        'events_rejected': generator.rejected,
+        'accepted_rate': generator.accepted / load_seconds,
+        'raids': len(generator.raids),
+        'notifications': len(telegram.delivered),
+        'notify_rate': len(telegram.delivered) / notify_seconds,
+        'telegram_calls': dict(telegram.calls),
+        'floods': telegram.floods,
+        'votes': telegram.votes,
+        'latency_p50': percentile(latencies, 50),
+        'latency_p90': percentile(latencies, 90),
+        'latency_p99': percentile(latencies, 99),
+        'latency_max': max(latencies) if latencies else None,
+        'rss_start_mb': rss_start,
+        'rss_peak_mb': peak if rss_start is not None else None,
+        'rss_growth_mb': (rss_end - rss_start
+                          if None not in (rss_start, rss_end) else None),
+        'teleraid': stats.get('teleraid')
+    }
+
+
+def scenario(args):
+    return dict((name, getattr(args, name)) for name in (
+        'engine', 'shards', 'format', 'rate', 'duration', 'batch', 'chats',
+        'latency', 'flood_rate', 'vote_rate', 'telegram_webhook',
+        'rate_limit_global', 'rate_limit_chat'))
+
+
+def report(result):
+    print("Events:        {} sent, {} rejected, {:.1f}/s accepted".format(
+        result['events_sent'], result['events_rejected'],
+        result['accepted_rate']))
+    print("Notifications: {} for {} raids in {} chats, {:.1f}/s".format(
+        result['notifications'], result['raids'],
+        result['scenario']['chats'], result['notify_rate']))
+    print("Telegram:      {} floods, {} votes, calls {}".format(
+        result['floods'], result['votes'],
+        json.dumps(result['telegram_calls'], sort_keys=True)))
+    if result['latency_p50'] is not None:
+        print("Latency:       p50 {:.3f}s, p90 {:.3f}s, p99 {:.3f}s, "
+              "max {:.3f}s".format(result['latency_p50'],
+                                   result['latency_p90'],
+                                   result['latency_p99'],
+                                   result['latency_max']))
+    if result['rss_start_mb'] is not None:
+        print("Memory:        {:.1f} MB at start, {:.1f} MB peak, "
+              "{:+.1f} MB growth".format(result['rss_start_mb'],
+                                         result['rss_peak_mb'],
+                                         result['rss_growth_mb']))
+
+
+def compare(result, baseline):
+    """Returns descriptions of all results worse than the baseline."""
+    if baseline.get('scenario') != result['scenario']:
+        print("Baseline was recorded for another scenario, not comparing.")
+        return []
+    regressions = []
+    for name, tolerance in sorted(TOLERANCE.items()):
+        old, new = baseline.get(name), result.get(name)
+        if not old or new is None:
+            continue
+        change = (new - old) / abs(old)
+        if (change < tolerance) if tolerance < 0 else (change > tolerance):
+            regressions.append("{}: {:.3f} -> {:.3f} ({:+.0%})".format(
+                name, old, new, change))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--rate', type=float, default=20,
+                        help='Webhook events per second.')
+    parser.add_argument('--duration', type=float, default=30,
+                        help='Seconds of load.')
+    parser.add_argument('--batch', type=int, default=10,
+                        help='Events per webhook POST.')
+    parser.add_argument('--engine', default='gevent',
+                        choices=('gevent', 'asyncio'))
+    parser.add_argument('--shards', type=int, default=0,
+                        help='Shard processes of TeleRaid (gevent engine).')
+    parser.add_argument('--format', default='sticker',
+                        choices=('sticker', 'venue', 'text'),
+                        help='Notification format of TeleRaid.')
+    parser.add_argument('--chats', type=int, default=3)
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='Seconds the fake Telegram takes per call.')
+    parser.add_argument('--flood-rate', type=float, default=0.0,
+                        help='Share of Telegram calls answered with 429.')
+    parser.add_argument('--vote-rate', type=float, default=0.5,
+                        help='Share of polls users vote on.')
+    parser.add_argument('--telegram-webhook', action='store_true',
+                        help='Receive votes via webhook instead of polling.')
+    # Telegram's real limits would make the rate limiter the bottleneck
+    parser.add_argument('--rate-limit-global', type=int, default=10000)
+    parser.add_argument('--rate-limit-chat', type=int, default=100000)
+    parser.add_argument('--queue-size', type=int, default=10000)
+    parser.add_argument('--port', type=int, default=4101,
+                        help='Port of the TeleRaid webhook server.')
+    parser.add_argument('--drain', type=float, default=300,
+                        help='Max. seconds to wait for notifications after '
+                        'the load ended.')
+    parser.add_argument('--python', default=sys.executable,
+                        help='Interpreter running TeleRaid.')
+    parser.add_argument('--keep', action='store_true',
+                        help='Keep the generated config and TeleRaid log.')
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='Store the results as new baseline.')
+    args = parser.parse_args()
+
+    result = run(args)
+    report(result)
+
+    baselines = {}
+    if os.path.exists(BASELINE):
+        with open(BASELINE) as f:
+            baselines = json.load(f)
+
+    if args.save_baseline:
+        baselines[args.engine] = result
+        with open(BASELINE, 'w') as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print("Saved baseline to {}.".format(BASELINE))
+    elif args.engine in baselines:
+        regressions = compare(result, baselines[args.engine])
+        for regression in regressions:
+            print("Regression in " + regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Webhook events per second the edge sustains on mixed scanner traffic.
+
+Decodes batches of mostly Pokemon, gym and pokestop events with some eggs
+and raids, of which the subscription only wants levels 4 and 5. Compares
+the previous edge, which decoded with the json module and only dropped
+duplicates, with the prefilter on the json module and on the JSON backend
+teleraid.ingest uses.
+
+    python -m benchmarks.bench_edge [batches] [batch size]
+"""
+
+import json
+import random
+import sys
+import timeit
+
+from teleraid import ingest
+from teleraid.geofence import GeofenceIndex
+from teleraid.ingest import Deduplicator, EventFilter, split_events
+from teleraid.routing import Filters, Router, Subscription
+
+# Roughly the extent of a large city
+LAT, LON, SPAN = 52.3, 13.1, 0.4
+
+
+def event(i, rng):
+    lat = round(LAT + rng.random() * SPAN, 6)
+    lon = round(LON + rng.random() * SPAN, 6)
+    r = rng.random()
+    if r < 0.6:
+        return {'type': 'pokemon', 'message': {
+            'encounter_id': str(rng.getrandbits(63)),
+            'spawnpoint_id': '{:x}'.format(rng.getrandbits(40)),
+            'pokemon_id': rng.randint(1, 386),
+            'latitude': lat, 'longitude': lon,
+            'disappear_time': 1500000000 + i,
+            'individual_attack': rng.randint(0, 15),
+            'individual_defense': rng.randint(0, 15),
+            'individual_stamina': rng.randint(0, 15),
+            'move_1': rng.randint(200, 280), 'move_2': rng.randint(10, 140),
+            'cp': rng.randint(10, 3000), 'gender': rng.randint(1, 3),
+            'weather_boosted_condition': 0}}
+    if r < 0.75:
+        return {'type': 'gym', 'message': {
+            'gym_id': 'gym{}'.format(i), 'latitude': lat, 'longitude': lon,
+            'team_id': rng.randint(0, 3),
+            'slots_available': rng.randint(0, 6),
+            'last_modified': 1500000000000 + i}}
+    if r < 0.85:
+        return {'type': 'pokestop', 'message': {
+            'pokestop_id': 'stop{}'.format(i), 'latitude': lat,
+            'longitude': lon, 'enabled': True, 'lure_expiration': None,
+            'last_modified': 1500000000000 + i}}
+    raid = {'gym_id': 'gym{}'.format(i), 'latitude': lat, 'longitude': lon,
+            'level': rng.randint(1, 5), 'pokemon_id': None,
+            'spawn': 1500000000 + i, 'start': 1500003600 + i,
+            'end': 1500006300 + i}
+    if r >= 0.9:
+        raid.update(pokemon_id=rng.randint(1, 386),
+                    move_1=rng.randint(200, 280),
+                    move_2=rng.randint(10, 140))
+    return {'type': 'raid', 'message': raid}
+
+
+def bodies(batches, size):
+    rng = random.Random(42)
+    return [json.dumps([event(b * size + i, rng) for i in range(size)])
+            .encode('utf-8') for b in range(batches)]
+
+
+def main():
+    batches = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    size = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    posts = bodies(batches, size)
+    filters = Filters(Router([Subscription('@raids', levels=[4, 5])]),
+                      GeofenceIndex([]))
+    queued = []
+
+    def legacy():
+        deduplicator = Deduplicator()
+        del queued[:]
+        for body in posts:
+            events = deduplicator.check(json.loads(body))
+            deduplicator.commit(events)
+            queued.extend(events)
+
+    def prefilter_json():
+        event_filter = EventFilter(filters)
+        deduplicator = Deduplicator()
+        del queued[:]
+        for body in posts:
+            events = deduplicator.check(
+                event_filter.filter(json.loads(body)))
+            deduplicator.commit(events)
+            queued.extend(events)
+
+    def prefilter():
+        event_filter = EventFilter(filters)
+        deduplicator = Deduplicator()
+        del queued[:]
+        for body in posts:
+            events = deduplicator.check(
+                event_filter.filter(split_events(body)))
+            deduplicator.commit(events)
+            queued.extend(events)
+
+    print("{} posts of {} events, JSON backend: {}".format(
+        batches, size, ingest._loads.__module__))
+    for name, run in (('legacy', legacy), ('json', prefilter_json),
+                      ('edge', prefilter)):
+        seconds = min(timeit.repeat(run, number=1, repeat=3))
+        print("{:>6}: {:10.0f} events/s, {:6} queued".format(
+            name, batches * size / seconds, len(queued)))
+
+
+if __name__ == '__main__':
+    main()
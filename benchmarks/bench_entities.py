@@ -0,0 +1,70 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Rendering cost of Telegram entities as HTML on long poll messages.
+
+Compares the previous slicing implementation of telepot_shiny with the
+single-pass entities_to_html.
+
+    python -m benchmarks.bench_entities [voters]
+"""
+
+import sys
+import timeit
+
+
+def legacy_telepot_shiny(message):
+    text = message.get('text', '')
+    entities = message.get('entities', [])
+
+    shinies = {
+        'bold': ('<b>', '</b>'),
+        'italic': ('<i>', '</i>')
+    }
+
+    add_off = 0
+    for e in entities:
+        if e['type'] in shinies:
+            text = (text[:add_off + e['offset']] +
+                    shinies[e['type']][0] +
+                    text[add_off+e['offset']:])
+            add_off += len(shinies[e['type']][0])
+
+            text = (text[:add_off+e['offset']+e['length']] +
+                    shinies[e['type']][1] +
+                    text[add_off+e['offset']+e['length']:])
+            add_off += len(shinies[e['type']][1])
+    return text
+
+
+def poll_message(voters):
+    """A raid message with a poll footer listing one bold line per voter."""
+    text = u'\nRaid - Level 5 - Mewtwo\nPsycho Cut / Shadow Ball\n' \
+        u'Raid ends at 17:45.\n\nYes'
+    entities = [{'type': 'bold', 'offset': 1, 'length': 23},
+                {'type': 'bold', 'offset': 63, 'length': 5},
+                {'type': 'bold', 'offset': 71, 'length': 3}]
+    for i in range(voters):
+        name = u'trainer_{}'.format(i)
+        entities.append({'type': 'italic', 'offset': len(text) + 1,
+                         'length': len(name)})
+        text += u'\n' + name
+    return {'text': text, 'entities': entities}
+
+
+def main():
+    from teleraid.utils import telepot_shiny
+
+    voters = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    message = poll_message(voters)
+    print("{} characters, {} entities".format(len(message['text']),
+                                              len(message['entities'])))
+    for name, render in (('legacy', legacy_telepot_shiny),
+                         ('one-pass', telepot_shiny)):
+        number = 20
+        seconds = timeit.timeit(lambda: render(message), number=number)
+        print("{:>8}: {:10.1f} us per render".format(
+            name, seconds / number * 1e6))
+
+
+if __name__ == '__main__':
+    main()
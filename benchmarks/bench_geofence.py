@@ -0,0 +1,74 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Cost of classifying gyms into geofences.
+
+Compares testing every fence naively with the grid index, and the grid
+index with its per-gym cache as hit by repeated raid webhooks.
+
+    python -m benchmarks.bench_geofence [gyms] [fences]
+"""
+
+import math
+import random
+import sys
+import timeit
+
+from teleraid.geofence import Circle, GeofenceIndex, Polygon
+
+# Roughly the extent of a large city
+LAT, LON, SPAN = 52.3, 13.1, 0.4
+
+
+def random_fences(count, rng):
+    fences = []
+    for i in range(count):
+        lat = LAT + rng.random() * SPAN
+        lon = LON + rng.random() * SPAN
+        if i % 4 == 0:
+            fences.append(Circle('circle{}'.format(i), (lat, lon),
+                                 rng.uniform(300, 1500)))
+            continue
+        radius = rng.uniform(0.005, 0.03)
+        corners = rng.randint(6, 24)
+        fences.append(Polygon('polygon{}'.format(i), [
+            (lat + radius * math.sin(2 * math.pi * k / corners) *
+             rng.uniform(0.6, 1.0),
+             lon + radius * math.cos(2 * math.pi * k / corners) *
+             rng.uniform(0.6, 1.0))
+            for k in range(corners)]))
+    return fences
+
+
+def main():
+    gyms = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+    rng = random.Random(42)
+    fences = random_fences(count, rng)
+    points = [('gym{}'.format(i), LAT + rng.random() * SPAN,
+               LON + rng.random() * SPAN) for i in range(gyms)]
+
+    start = timeit.default_timer()
+    index = GeofenceIndex(fences)
+    print("{} fences indexed in {:.1f} ms.".format(
+        count, (timeit.default_timer() - start) * 1000))
+
+    def naive():
+        for gym_id, lat, lon in points:
+            frozenset(f.name for f in fences if f.contains(lat, lon))
+
+    def grid():
+        for gym_id, lat, lon in points:
+            index.fences_at(lat, lon)
+
+    def cached():
+        for gym_id, lat, lon in points:
+            index.classify(gym_id, lat, lon)
+
+    cached()
+    for name, run in (('naive', naive), ('grid', grid), ('cached', cached)):
+        seconds = min(timeit.repeat(run, number=1, repeat=3))
+        print("{:>6}: {:8.2f} us per gym".format(name, seconds / gyms * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Memory held for tracked raids and polls.
+
+Compares the previous representation, full webhook dicts and nested
+message dicts with a copy of the message text, with the records of
+teleraid.records. Needs Python 3 for tracemalloc.
+
+    python -m benchmarks.bench_memory [raids] [polls] [voters]
+"""
+
+import gc
+import sys
+import tracemalloc
+
+BODY = (u'\n<b>Raid - Level 5 - Mewtwo</b>\nPsycho Cut / Shadow Ball\n'
+        u'Raid ends at <b>17:{:02d}</b>.')
+
+
+def webhook(i):
+    """A raid webhook message with the fields RocketMap sends."""
+    return {
+        'gym_id': u'gym{}'.format(i),
+        'gym_name': u'Gym number {}'.format(i),
+        'url': u'http://example.com/gyms/{}.jpg'.format(i),
+        'team_id': i % 4,
+        'is_exclusive': False,
+        'sponsor': None,
+        'park': None,
+        'level': 1 + i % 5,
+        'pokemon_id': 150,
+        'cp': 54000,
+        'move_1': 234,
+        'move_2': 70,
+        'gender': 3,
+        'form': None,
+        'spawn': 1500000000 + i,
+        'start': 1500003600 + i,
+        'end': 1500006300 + i,
+        'latitude': 52.3 + i * 1e-6,
+        'longitude': 13.1 + i * 1e-6
+    }
+
+
+def legacy(raids, polls, voters):
+    tracked = {}
+    for i in range(raids):
+        raid = webhook(i)
+        raid['notified_battle'] = True
+        tracked[raid['gym_id']] = raid
+
+    messages = {}
+    for i in range(polls):
+        users = {}
+        for user_id in range(voters):
+            users[user_id] = {'id': user_id, 'data': 'yn'[user_id % 2],
+                              'username': u'trainer{}'.format(user_id)}
+        messages[(-1001000000000, 3 * i + 3)] = {
+            'gym_id': u'gym{}'.format(i),
+            'body': BODY.format(i % 60),
+            'poll': {'yes': voters // 2, 'no': voters - voters // 2,
+                     'users': users},
+            'ids': {'sticker_id': 3 * i + 1, 'location_id': 3 * i + 2,
+                    'message_id': 3 * i + 3}
+        }
+    return tracked, messages
+
+
+def records(raids, polls, voters):
+    from teleraid.records import Message, Raid, SentIds
+
+    tracked = {}
+    for i in range(raids):
+        raid = Raid.from_webhook(webhook(i))
+        raid.notified = True
+        tracked[raid.gym_id] = raid
+
+    messages = {}
+    for i in range(polls):
+        message = Message(u'gym{}'.format(i),
+                          ids=SentIds(3 * i + 1, 3 * i + 2, 3 * i + 3))
+        for user_id in range(voters):
+            message.vote(user_id, u'trainer{}'.format(user_id),
+                         'yn'[user_id % 2])
+        messages[(-1001000000000, 3 * i + 3)] = message
+    return tracked, messages
+
+
+def measure(build, *args):
+    gc.collect()
+    tracemalloc.start()
+    held = build(*args)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del held
+    return size
+
+
+def main():
+    raids = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    polls = int(sys.argv[2]) if len(sys.argv) > 2 else 10000
+    voters = int(sys.argv[3]) if len(sys.argv) > 3 else 5
+    print("{} raids, {} polls with {} voters each".format(raids, polls,
+                                                          voters))
+    for name, build in (('legacy', legacy), ('records', records)):
+        raid_size = measure(build, raids, 0, 0)
+        poll_size = measure(build, 0, polls, voters)
+        print("{:>8}: {:7.1f} MB raids, {:7.1f} MB polls".format(
+            name, raid_size / 2.0 ** 20, poll_size / 2.0 ** 20))
+
+
+if __name__ == '__main__':
+    main()
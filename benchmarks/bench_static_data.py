@@ -0,0 +1,82 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Per-notification cost of Pokemon and move name lookups.
+
+Compares the previous lazily loading helpers, which re-parsed the moves
+file on every call, with the StaticData registry.
+
+    python -m benchmarks.bench_static_data [locale] [notifications]
+"""
+
+import json
+import os
+import sys
+import timeit
+
+from teleraid.registry import STATIC_DIR, get_static_data
+
+
+def legacy_lookups(locale):
+    def i18n(word):
+        if locale == "en":
+            return word
+        if not hasattr(i18n, 'dictionary'):
+            file_path = os.path.join(STATIC_DIR, 'locales',
+                                     '{}.json'.format(locale))
+            with open(file_path, 'r') as f:
+                i18n.dictionary = json.loads(f.read())
+        return i18n.dictionary.get(word, word)
+
+    def get_pokemon_data(pokemon_id):
+        if not hasattr(get_pokemon_data, 'pokemon'):
+            file_path = os.path.join(STATIC_DIR, 'pokemon.json')
+            with open(file_path, 'r') as f:
+                get_pokemon_data.pokemon = json.loads(f.read())
+        return get_pokemon_data.pokemon[str(pokemon_id)]
+
+    def get_moves_data(move_id):
+        # Checked for an attribute that was never set, so always re-read
+        if not hasattr(get_moves_data, 'en'):
+            file_path = os.path.join(STATIC_DIR,
+                                     'moves_{}.json'.format(locale))
+            with open(file_path, 'r') as f:
+                get_moves_data.moves = json.loads(f.read())
+        return get_moves_data.moves[str(move_id)]
+
+    def notification():
+        i18n(get_pokemon_data(150)['name']).encode('utf-8')
+        get_moves_data(222)['name'].encode('utf-8')
+        get_moves_data(228)['name'].encode('utf-8')
+
+    return notification
+
+
+def registry_lookups(locale):
+    data = get_static_data()
+
+    def notification():
+        data.pokemon_name(150, locale)
+        data.move_name(222, locale)
+        data.move_name(228, locale)
+
+    return notification
+
+
+def main():
+    locale = sys.argv[1] if len(sys.argv) > 1 else 'de'
+    number = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+
+    start = timeit.default_timer()
+    get_static_data()
+    print("Registry built in {:.1f} ms.".format(
+        (timeit.default_timer() - start) * 1000))
+
+    for name, setup in (('legacy', legacy_lookups),
+                        ('registry', registry_lookups)):
+        seconds = timeit.timeit(setup(locale), number=number)
+        print("{:>8}: {:10.2f} us per notification".format(
+            name, seconds / number * 1e6))
+
+
+if __name__ == '__main__':
+    main()
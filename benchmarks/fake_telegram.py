@@ -0,0 +1,329 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Local stand-in for the Telegram Bot API.
+
+Answers the methods TeleRaid uses with plausible results after a
+configurable latency, rejects a share of calls with a 429 flood wait and
+lets simulated users vote on sent polls, either through getUpdates or by
+posting to a webhook registered with setWebhook. Point TeleRaid at it with
+the 'telegram_api_url' config option.
+
+    python -m benchmarks.fake_telegram [--port 4002] [--latency 0.05]
+        [--flood-rate 0.01] [--vote-rate 0.5]
+"""
+
+import argparse
+import json
+import random
+import re
+import socket
+import sys
+import threading
+import time
+
+from collections import defaultdict, deque
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qsl
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qsl
+
+import urllib3
+
+METHOD_PATH = re.compile(r'^/bot[^/]+/(\w+)$')
+SENDING_METHODS = ('sendMessage', 'sendLocation', 'sendSticker',
+                   'sendVenue')
+MAP_LINK = re.compile(r'maps\?q=(-?[\d.]+),(-?[\d.]+)')
+
+
+class FakeTelegram(object):
+    """State and behaviour of the fake Bot API, independent of HTTP.
+
+    Every answered sendMessage is matched to the latest unmatched
+    sendLocation of the same chat, which is how TeleRaid orders the
+    messages of one notification. Single message notifications, a
+    sendVenue or a sendMessage with a map link, are complete on their own.
+    `delivered` thereby lists when each raid location was completely
+    notified.
+    """
+
+    def __init__(self, latency=0.0, flood_rate=0.0, retry_after=1,
+                 vote_rate=0.0, max_votes=5, seed=None):
+        self.latency = latency
+        self.flood_rate = flood_rate
+        self.retry_after = retry_after
+        self.vote_rate = vote_rate
+        self.max_votes = max_votes
+
+        self.calls = defaultdict(int)
+        self.floods = 0
+        self.votes = 0
+        self.delivered = []
+
+        self.__random = random.Random(seed)
+        self.__lock = threading.Lock()
+        self.__message_ids = defaultdict(int)
+        self.__chat_ids = {}
+        self.__locations = defaultdict(deque)
+        self.__updates = []
+        self.__update_id = 0
+        self.__has_updates = threading.Condition(self.__lock)
+        self.__webhook = None
+        self.__http = urllib3.PoolManager(maxsize=4)
+
+    def call(self, method, params):
+        """Returns the status code and JSON payload answering `method`."""
+        if self.latency:
+            time.sleep(self.latency)
+        with self.__lock:
+            self.calls[method] += 1
+            if (method in SENDING_METHODS or method.startswith('edit')) and \
+                    self.__random.random() < self.flood_rate:
+                self.floods += 1
+                return 429, {
+                    'ok': False,
+                    'error_code': 429,
+                    'description': 'Too Many Requests: retry after {}'
+                                   .format(self.retry_after),
+                    'parameters': {'retry_after': self.retry_after}
+                }
+
+        if method == 'getUpdates':
+            return 200, {'ok': True, 'result': self.__get_updates(params)}
+        if method == 'setWebhook':
+            self.__webhook = params.get('url') or None
+            return 200, {'ok': True, 'result': True}
+        if method == 'deleteWebhook':
+            self.__webhook = None
+            return 200, {'ok': True, 'result': True}
+        if method == 'getMe':
+            return 200, {'ok': True, 'result': {
+                'id': 1, 'is_bot': True, 'first_name': 'FakeTeleRaid'}}
+        if method in SENDING_METHODS:
+            return 200, {'ok': True, 'result': self.__send(method, params)}
+        if method.startswith('edit'):
+            return 200, {'ok': True, 'result': self.__message(
+                params.get('chat_id'), int(params['message_id']),
+                params.get('text'))}
+        if method == 'deleteMessage':
+            self.__delete(params.get('chat_id'), int(params['message_id']))
+            return 200, {'ok': True, 'result': True}
+        if method == 'deleteMessages':
+            message_ids = params.get('message_ids') or []
+            if not isinstance(message_ids, list):
+                message_ids = json.loads(message_ids)
+            for message_id in message_ids:
+                self.__delete(params.get('chat_id'), int(message_id))
+            return 200, {'ok': True, 'result': True}
+        return 404, {'ok': False, 'error_code': 404,
+                     'description': 'Not Found: method not found'}
+
+    def __chat_id(self, chat_id):
+        # Channels given by @username are answered with a numeric ID
+        try:
+            return int(chat_id)
+        except (TypeError, ValueError):
+            return self.__chat_ids.setdefault(
+                chat_id, -1001000000000 - len(self.__chat_ids))
+
+    def __message(self, chat_id, message_id, text=None):
+        message = {
+            'message_id': message_id,
+            'date': int(time.time()),
+            'chat': {'id': self.__chat_id(chat_id), 'type': 'supergroup'}
+        }
+        if text is not None:
+            message['text'] = text
+        return message
+
+    def __send(self, method, params):
+        now = time.time()
+        with self.__lock:
+            chat_id = self.__chat_id(params.get('chat_id'))
+            self.__message_ids[chat_id] += 1
+            message = self.__message(chat_id, self.__message_ids[chat_id])
+            if method == 'sendLocation':
+                self.__locations[chat_id].append((
+                    message['message_id'],
+                    _location(params['latitude'], params['longitude'])))
+            elif method == 'sendVenue':
+                self.delivered.append((now, _location(params['latitude'],
+                                                      params['longitude'])))
+            elif method == 'sendMessage':
+                message['text'] = params.get('text', '')
+                link = MAP_LINK.search(message['text'])
+                if link:
+                    self.delivered.append((now, _location(*link.groups())))
+                elif self.__locations[chat_id]:
+                    self.delivered.append(
+                        (now, self.__locations[chat_id].popleft()[1]))
+        if method in ('sendMessage', 'sendVenue') and \
+                params.get('reply_markup') and \
+                self.__random.random() < self.vote_rate:
+            self.__schedule_votes(message)
+        return message
+
+    def __delete(self, chat_id, message_id):
+        # A location deleted before its text was sent has no notification
+        with self.__lock:
+            locations = self.__locations[self.__chat_id(chat_id)]
+            for entry in list(locations):
+                if entry[0] == message_id:
+                    locations.remove(entry)
+
+    def __schedule_votes(self, message):
+        for i in range(self.__random.randint(1, self.max_votes)):
+            user_id = self.__random.randint(1, 10 ** 6)
+            timer = threading.Timer(
+                self.__random.uniform(0.1, 5.0), self.__vote,
+                (message, user_id, self.__random.choice('yn')))
+            timer.daemon = True
+            timer.start()
+
+    def __vote(self, message, user_id, data):
+        with self.__lock:
+            self.votes += 1
+            self.__update_id += 1
+            update = {
+                'update_id': self.__update_id,
+                'callback_query': {
+                    'id': str(self.__update_id),
+                    'from': {'id': user_id, 'is_bot': False,
+                             'first_name': 'Trainer',
+                             'username': 'trainer{}'.format(user_id)},
+                    'message': message,
+                    'data': data
+                }
+            }
+            webhook = self.__webhook
+            if webhook is None:
+                self.__updates.append(update)
+                self.__has_updates.notify_all()
+                return
+        try:
+            self.__http.request('POST', webhook, body=json.dumps(update),
+                                headers={'Content-Type': 'application/json'})
+        except Exception:
+            pass
+
+    def __get_updates(self, params):
+        offset = int(params.get('offset') or 0)
+        deadline = time.time() + float(params.get('timeout') or 0)
+        with self.__lock:
+            self.__updates = [u for u in self.__updates
+                              if u['update_id'] >= offset]
+            while not self.__updates and time.time() < deadline:
+                self.__has_updates.wait(deadline - time.time())
+            return list(self.__updates)
+
+
+def _location(latitude, longitude):
+    return round(float(latitude), 6), round(float(longitude), 6)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body leave in one segment, without waiting for delayed
+    # ACKs of the client
+    disable_nagle_algorithm = True
+    wbufsize = -1
+
+    def do_POST(self):
+        match = METHOD_PATH.match(self.path)
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        if match is None:
+            status, payload = 404, {'ok': False, 'error_code': 404,
+                                    'description': 'Not Found'}
+        else:
+            status, payload = self.server.telegram.call(
+                match.group(1),
+                parse_params(self.headers.get('Content-Type') or '', body))
+        data = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    do_GET = do_POST
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def handle_error(self, request, client_address):
+        # Clients going away mid-answer, e.g. a terminated long poll
+        if not isinstance(sys.exc_info()[1], socket.error):
+            HTTPServer.handle_error(self, request, client_address)
+
+
+def parse_params(content_type, body):
+    """Decodes telepot's multipart or urlencoded fields, or a JSON body."""
+    if content_type.startswith('multipart/form-data'):
+        boundary = content_type.split('boundary=', 1)[1].strip('"')
+        params = {}
+        for part in body.split(b'--' + boundary.encode('ascii')):
+            headers, _, value = part.partition(b'\r\n\r\n')
+            name = re.search(br'name="([^"]*)"', headers)
+            if name:
+                params[name.group(1).decode('utf-8')] = \
+                    value[:-2].decode('utf-8')
+        return params
+    if content_type.startswith('application/json'):
+        return json.loads(body.decode('utf-8')) if body else {}
+    return dict(parse_qsl(body.decode('utf-8')))
+
+
+def serve(telegram, host='127.0.0.1', port=0):
+    """Serves `telegram` in a background thread, returns the server.
+
+    The base URL to configure as 'telegram_api_url' is
+    'http://{host}:{server.server_port}'.
+    """
+    server = _Server((host, port), _Handler)
+    server.telegram = telegram
+    thread = threading.Thread(target=server.serve_forever,
+                              name='FakeTelegram')
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=4002)
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='Seconds before every answer.')
+    parser.add_argument('--flood-rate', type=float, default=0.0,
+                        help='Share of send and edit calls answered with '
+                        '429.')
+    parser.add_argument('--retry-after', type=int, default=1)
+    parser.add_argument('--vote-rate', type=float, default=0.5,
+                        help='Share of polls users vote on.')
+    args = parser.parse_args()
+
+    telegram = FakeTelegram(args.latency, args.flood_rate, args.retry_after,
+                            args.vote_rate)
+    server = serve(telegram, args.host, args.port)
+    print("Fake Telegram Bot API on http://{}:{}".format(
+        args.host, server.server_port))
+    try:
+        while True:
+            time.sleep(10)
+            print("calls: {}, floods: {}, votes: {}".format(
+                dict(telegram.calls), telegram.floods, telegram.votes))
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,170 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Synthetic RocketMap webhook load.
+
+Posts batches of raid, egg and gym events at a fixed rate to TeleRaid's
+webhook endpoint. Every new raid takes place at its own gym with unique
+coordinates, so its notification can be recognized by its location. A
+share of raids is reported again, like scanners do on every rescan.
+
+    python -m benchmarks.loadgen [--url http://127.0.0.1:4001/]
+        [--rate 100] [--duration 60] [--batch 10]
+"""
+
+import argparse
+import json
+import random
+import time
+
+import urllib3
+
+from teleraid.registry import get_static_data
+
+# Roughly the extent of a large city
+LAT, LON, SPAN = 52.3, 13.1, 0.4
+
+
+class LoadGenerator(object):
+    """Generates and posts webhook events.
+
+    `raids` maps the (lat, lon) of every raid posted for the first time to
+    the time its webhook was sent.
+    """
+
+    def __init__(self, url, rate=100, batch=10, raid_share=0.3,
+                 repeat_share=0.3, egg_share=0.2, seed=None):
+        self.url = url
+        self.rate = float(rate)
+        self.batch = batch
+        self.raid_share = raid_share
+        self.repeat_share = repeat_share
+        self.egg_share = egg_share
+
+        self.raids = {}
+        self.sent = 0
+        self.accepted = 0
+        self.rejected = 0
+        self.errors = 0
+
+        self.__random = random.Random(seed)
+        # Only bosses and moves TeleRaid can render a notification for
+        data = get_static_data()
+        self.__bosses = [i for i, sticker in enumerate(data.stickers)
+                         if sticker and data.pokemon_names['en'][i]]
+        self.__moves = [i for i, name in enumerate(data.move_names['en'])
+                        if name]
+        self.__http = urllib3.PoolManager(maxsize=1, retries=False)
+        self.__gyms = 0
+        self.__posted = []
+
+    def __gym(self):
+        self.__gyms += 1
+        return ('gym{}'.format(self.__gyms),
+                round(LAT + self.__random.random() * SPAN, 6),
+                round(LON + self.__random.random() * SPAN, 6))
+
+    def event(self, now):
+        """Returns a random webhook event and whether it is a new raid."""
+        r = self.__random.random()
+        if r < self.raid_share * self.repeat_share and self.__posted:
+            return self.__random.choice(self.__posted), False
+        if r < self.raid_share:
+            gym_id, lat, lon = self.__gym()
+            event = {'type': 'raid', 'message': {
+                'gym_id': gym_id,
+                'latitude': lat,
+                'longitude': lon,
+                'level': self.__random.randint(1, 5),
+                'pokemon_id': self.__random.choice(self.__bosses),
+                'move_1': self.__random.choice(self.__moves),
+                'move_2': self.__random.choice(self.__moves),
+                'spawn': int(now) - 3600,
+                'start': int(now) - 60,
+                'end': int(now) + 2700
+            }}
+            self.__posted.append(event)
+            return event, True
+        if r < self.raid_share + self.egg_share:
+            gym_id, lat, lon = self.__gym()
+            return {'type': 'raid', 'message': {
+                'gym_id': gym_id,
+                'latitude': lat,
+                'longitude': lon,
+                'level': self.__random.randint(1, 5),
+                'pokemon_id': None,
+                'spawn': int(now),
+                'start': int(now) + 3600,
+                'end': int(now) + 6300
+            }}, False
+        gym_id, lat, lon = self.__gym()
+        return {'type': 'gym', 'message': {
+            'gym_id': gym_id,
+            'latitude': lat,
+            'longitude': lon,
+            'team_id': self.__random.randint(0, 3),
+            'slots_available': self.__random.randint(0, 6),
+            'last_modified': int(now) * 1000
+        }}, False
+
+    def post(self):
+        now = time.time()
+        events = [self.event(now) for i in range(self.batch)]
+        try:
+            response = self.__http.request(
+                'POST', self.url,
+                body=json.dumps([e for e, new in events]),
+                headers={'Content-Type': 'application/json'})
+        except Exception:
+            self.errors += len(events)
+            return
+        self.sent += len(events)
+        if response.status == 429:
+            self.rejected += len(events)
+        elif response.status == 200:
+            self.accepted += len(events)
+            for event, new in events:
+                if new:
+                    message = event['message']
+                    self.raids[(message['latitude'],
+                                message['longitude'])] = now
+        else:
+            self.errors += len(events)
+
+    def run(self, duration):
+        """Posts for `duration` seconds, returns the achieved event rate.
+
+        Batches are due at fixed intervals. A slow server delays them but
+        the generator catches up afterwards, like a queueing scanner.
+        """
+        interval = self.batch / self.rate
+        start = time.time()
+        due = start
+        while due < start + duration:
+            delay = due - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            self.post()
+            due += interval
+        return self.sent / (time.time() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--url', default='http://127.0.0.1:4001/')
+    parser.add_argument('--rate', type=float, default=100,
+                        help='Events per second.')
+    parser.add_argument('--duration', type=float, default=60)
+    parser.add_argument('--batch', type=int, default=10,
+                        help='Events per POST.')
+    args = parser.parse_args()
+
+    generator = LoadGenerator(args.url, args.rate, args.batch)
+    rate = generator.run(args.duration)
+    print("Sent {} events at {:.1f}/s: {} accepted, {} rejected, {} failed, "
+          "{} new raids.".format(generator.sent, rate, generator.accepted,
+                                 generator.rejected, generator.errors,
+                                 len(generator.raids)))
+
+
+if __name__ == '__main__':
+    main()
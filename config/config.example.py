@@ -9,8 +9,67 @@ config = {
     'chat_id': "#TELEGRAM_CHAT_ID#",  # Chat-ID of the Telegram channel.
     'host': "127.0.0.1",  # IP of your RocketMap webhook.
     'port': 4001,  # Port of your RocketMap webhook.
+    # 'gevent', or 'asyncio' to serve everything on one event loop with
+    # pooled Telegram connections (needs Python 3.7+ and aiohttp).
+    'engine': 'gevent',
+    'telegram_pool_size': 20,  # Max. open Telegram connections (asyncio).
+    'queue_size': 10000,  # Max. webhook events waiting to be processed.
+    'queue_retry_after': 5,  # Seconds senders should wait if queue is full.
+    # Public base URL under which Telegram reaches this server. If set,
+    # votes are received via webhook instead of polling getUpdates.
+    'telegram_webhook_url': None,
+    # Path secret of the webhook above, a hash of the bot token if not set.
+    # 'telegram_webhook_secret': "#RANDOM_SECRET#",
+    # Base URL of the Bot API, None for https://api.telegram.org. Points
+    # TeleRaid at another server, e.g. python -m benchmarks.fake_telegram.
+    'telegram_api_url': None,
+    'rate_limit_global': 30,  # Max. Telegram calls per second in total.
+    'rate_limit_chat': 20,  # Max. Telegram calls per minute and chat.
+    'max_flood_retries': 3,  # Retries of a call Telegram asked to delay.
+    'notify_workers': 8,  # Telegram calls sent concurrently (gevent engine).
+    'outbox_max_attempts': 5,  # Tries of a notification, edit or deletion.
+    'outbox_backoff': 1,  # Seconds before the first retry, doubled per try.
+    'delete_interval': 5,  # Seconds expired messages are collected for.
+    # Processes raids are spread across, 0 to process everything here.
+    'shards': 0,
+    'shard_by': 'gym',  # Partition raids by 'gym' or by area 'cell'.
+    'shard_cell_size': 0.1,  # Edge of an area cell in degrees.
+    # 'host:port' of shards started with 'start_teleraid.py --shard <i>',
+    # None to start them here on the ports following 'port'.
+    'shard_addresses': None,
+    'shard_secret': None,  # Shared secret of the front-end and its shards.
+    # 'sticker' sends a sticker, a location and the text with the poll.
+    # 'venue' or 'text' (with a map link) send just one message.
+    'notification_format': 'sticker',
+    # Seconds between checks of this file for changes, 0 to only reload
+    # it on SIGHUP.
+    'config_check_interval': 5,
+    # Log webhook events taking longer than this many seconds to be
+    # notified, with the time spent per stage. None to trace nothing.
+    'trace_slow_seconds': 10,
+    # Secret of the admin endpoints under /admin/<secret>/, None to disable
+    # them.
+    'admin_secret': None,
+    'poll_edit_interval': 3,  # Min. seconds between edits of a poll message.
+    'template_cache_size': 512,  # Rendered raid headers kept in memory.
+    # Keeps raids, messages and votes across restarts, None to disable.
+    'store': 'sqlite',
+    'store_path': 'teleraid.db',  # SQLite database file of the store.
     'timezone': 0,  # UTC timezone offset for the notify time, can be negative
     'locale': 'en',  # Language of Pokemon names and moves.
+    # Chats to notify, each with its own filters. Settings missing in a chat
+    # are taken from the top-level ones. If set, 'chat_id' is not notified.
+    # e.g. [{'chat_id': "@legendary_raids", 'notify_levels': [5]},
+    #       {'chat_id': -1001234567890, 'locale': 'de', 'timezone': 2}]
+    'chats': [],
+    # Named areas, either a polygon as list of [lat, lon] points or a circle
+    # e.g. {'Downtown': [[52.52, 13.40], [52.53, 13.41], [52.51, 13.42]],
+    #       'Park': {'center': [52.50, 13.35], 'radius': 800}}
+    'geofences': {},
+    'geofence_file': None,  # JSON or RocketMap style file with more areas.
+    'geofence_cell_size': 0.01,  # Grid cell edge of the fence index in deg.
+    # Only notify about raids inside these areas, None for everywhere.
+    'notify_geofences': None,
     'notify_levels': [1, 2, 3, 4, 5],  # List of raid levels to notify about
     # List of Raid Pokemon to notify about
     'notify_pokemon': [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15, 16,
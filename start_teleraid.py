@@ -1,21 +1,39 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
+from config.config import config
+
+# Patch before anything else imports threading or socket, otherwise threads
+# keep sockets bound to another thread's hub and wait on each other
+if config.get('engine', 'gevent') == 'gevent':
+    from gevent import monkey
+    monkey.patch_all()
+
+import hmac
 import json
-import Queue
 import logging
+import sys
+
+try:
+    import Queue
+except ImportError:
+    import queue as Queue
 
 from threading import Thread
-from gevent import monkey
-from gevent import wsgi
-from flask import Flask, request
+from time import sleep
+from gevent import pywsgi
+from flask import Flask, Response, request, jsonify
 
 # Custom files and packages
-from config.config import config
 from teleraid.teleraid import TeleRaid
+from teleraid.ingest import (Deduplicator, EventFilter, EventQueue,
+                             split_events)
+from teleraid.metrics import REGISTRY, gauge
+from teleraid.reload import watch_config
+from teleraid.routing import filters_from_config
+from teleraid.tracing import MAX_PROFILE_SECONDS, Profiler, Tracer
 
 
-monkey.patch_all()
 logging.basicConfig(
     format='%(asctime)s [%(threadName)18s][%(module)14s][%(levelname)8s] ' +
     '%(message)s')
@@ -25,30 +43,129 @@ if config.get('debug', False):
 else:
     log.setLevel(logging.INFO)
 
+if config.get('engine', 'gevent') == 'asyncio':
+    from teleraid.aio import run
+    log.info("TeleRaid starts.")
+    run()
+    log.info("TeleRaid ended.")
+    sys.exit()
+
+if config.get('shards') and '--shard' in sys.argv:
+    # A shard started on its own, e.g. on another machine
+    from teleraid.shard import serve_shard
+    serve_shard(int(sys.argv[sys.argv.index('--shard') + 1]))
+    sys.exit()
+
 app = Flask(__name__)
-data_queue = Queue.Queue()
+if config.get('shards'):
+    # Raids are processed by shards, this process only partitions events
+    # and Telegram updates among them
+    from teleraid.shard import (Partitioner, ShardClient, ShardedBot,
+                                ShardedQueue, shard_addresses, start_shards)
+    addresses = shard_addresses(config)
+    if not config.get('shard_addresses'):
+        shards = start_shards(len(addresses))
+    clients = [ShardClient(a, config.get('shard_secret')) for a in addresses]
+    partitioner = Partitioner(len(clients), config.get('shard_by', 'gym'),
+                              config.get('shard_cell_size', 0.1))
+    data_queue = ShardedQueue(clients, partitioner)
+    raid_bot = ShardedBot(clients, partitioner)
+else:
+    data_queue = EventQueue(maxsize=config.get('queue_size', 10000))
+    raid_bot = TeleRaid(data_queue)
+# Events no chat wants are dropped before they are queued or handed to a
+# shard
+event_filter = EventFilter(filters_from_config(config))
+deduplicator = Deduplicator()
+tracer = Tracer(config.get('trace_slow_seconds', 10))
+profiler = Profiler()
+# Shards reload the config on their own
+if config.get('shards'):
+    reloading = [event_filter.reload]
+else:
+    reloading = [event_filter.reload, raid_bot.reload]
+gauge('teleraid_queue_depth', 'Webhook events waiting in the queue.',
+      data_queue.qsize)
 
 
 @app.route('/', methods=['POST'])
 def accept_webhook():
     try:
-        data = json.loads(request.data)
-        data_queue.put(data)
-    except Exception as e:
-        log.exception("Encountered error while receiving webhook ({}: {})"
-                      .format(type(e).__name__, e))
-        pass
+        events = split_events(request.data)
+    except ValueError as e:
+        log.warning("Received malformed webhook: {}".format(repr(e)))
+        return "Bad Request", 400
+
+    events = deduplicator.check(event_filter.filter(events))
+    tracer.tag(events)
+    try:
+        data_queue.put_many(events, accepted=deduplicator.commit)
+    except Queue.Full:
+        log.warning("Queue is full, rejected {} webhook events."
+                    .format(len(events)))
+        return "Too Many Requests", 429, {
+            'Retry-After': str(config.get('queue_retry_after', 5))}
 
     return "OK"  # request ok
 
 
+@app.route('/telegram/<secret>', methods=['POST'])
+def accept_telegram_update(secret):
+    if not hmac.compare_digest(request.path.encode('utf-8'),
+                               raid_bot.webhook_path.encode('utf-8')):
+        return "Not Found", 404
+
+    try:
+        raid_bot.handle_update(json.loads(request.data))
+    except ValueError as e:
+        log.warning("Received malformed Telegram update: {}".format(repr(e)))
+        return "Bad Request", 400
+
+    return "OK"
+
+
+@app.route('/stats', methods=['GET'])
+def stats():
+    return jsonify(queue=data_queue.stats(), teleraid=raid_bot.stats(),
+                   ignored=event_filter.ignored,
+                   duplicates=deduplicator.duplicates)
+
+
+@app.route('/admin/<secret>/profile', methods=['POST'])
+def profile(secret):
+    if not config.get('admin_secret') or not hmac.compare_digest(
+            secret.encode('utf-8'), config['admin_secret'].encode('utf-8')):
+        return "Not Found", 404
+
+    try:
+        seconds = min(float(request.args.get('seconds', 10)),
+                      MAX_PROFILE_SECONDS)
+    except ValueError:
+        return "Bad Request", 400
+    if not profiler.start():
+        return "Already profiling", 409
+    log.info("Profiling for {:.0f}s.".format(seconds))
+    try:
+        sleep(seconds)
+    finally:
+        stats = profiler.stop()
+    return Response(stats, mimetype='text/plain')
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(REGISTRY.render(),
+                    mimetype='text/plain; version=0.0.4')
+
+
 log.info("TeleRaid starts.")
 try:
-    t = Thread(target=TeleRaid, name='TeleRaid', args=(data_queue,))
+    watch_config(reloading, config.get('config_check_interval', 5))
+    t = Thread(target=raid_bot.run, name='TeleRaid')
     t.daemon = True
     t.start()
 
-    server = wsgi.WSGIServer((config['host'], config['port']), app)
+    server = pywsgi.WSGIServer((config['host'], config['port']), app)
     server.serve_forever()
 except KeyboardInterrupt:
     pass
@@ -0,0 +1,479 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""TeleRaid on a single asyncio event loop.
+
+Webhook ingestion, the raid scheduler, Telegram updates and all Telegram
+calls share one loop. Calls go through a keep-alive connection pool, so
+notifications of different raids and chats are sent concurrently instead
+of one after another. Needs Python 3.7+ and aiohttp, and is selected with
+the 'engine' config option.
+"""
+
+import asyncio
+import hmac
+import json
+import signal
+import logging
+
+from time import time
+
+import aiohttp
+from aiohttp import web
+from telepot.exception import BadHTTPResponse, TelegramError
+
+# Custom files and packages
+from config.config import config
+from .core import STAGE_SECONDS, TELEGRAM_SECONDS, TeleRaidCore
+from .ingest import (EVENTS, QUEUE_WAIT, Deduplicator, EventFilter,
+                     split_events)
+from .metrics import REGISTRY, gauge
+from .reload import ConfigWatcher, config_path
+from .tracing import MAX_PROFILE_SECONDS, Profiler
+
+log = logging.getLogger(__name__)
+
+# Seconds a getUpdates long poll waits for updates
+POLL_TIMEOUT = 30
+
+
+def _jsonable(value):
+    # telepot's namedtuples (e.g. keyboards) are sent as plain objects
+    if isinstance(value, tuple) and hasattr(value, '_asdict'):
+        value = value._asdict()
+    if isinstance(value, dict):
+        return dict((k, _jsonable(v)) for k, v in value.items()
+                    if v is not None)
+    if isinstance(value, (list, tuple)):
+        return [_jsonable(v) for v in value]
+    return value
+
+
+class AsyncTelegramClient(object):
+    """Bot API client on a pool of keep-alive connections.
+
+    Takes the same arguments as the methods of telepot's Bot, including
+    `msg_identifier`, and raises telepot's exceptions.
+    """
+
+    def __init__(self, token, base_url=None, pool_size=20, timeout=30):
+        self.__url = '{}/bot{}/'.format(
+            (base_url or 'https://api.telegram.org').rstrip('/'), token)
+        self.__pool_size = pool_size
+        self.__timeout = timeout
+        self.__session = None
+
+    async def start(self):
+        # Sessions belong to the loop they are created in
+        self.__session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.__pool_size,
+                                           keepalive_timeout=60),
+            timeout=aiohttp.ClientTimeout(total=self.__timeout))
+
+    async def close(self):
+        if self.__session is not None:
+            await self.__session.close()
+
+    async def call(self, method, **params):
+        msg_identifier = params.pop('msg_identifier', None)
+        if msg_identifier is not None:
+            params['chat_id'], params['message_id'] = msg_identifier
+        timeout = None
+        if 'timeout' in params:
+            # Long polls must not run into the HTTP timeout
+            timeout = aiohttp.ClientTimeout(
+                total=params['timeout'] + self.__timeout)
+
+        async with self.__session.post(self.__url + method,
+                                       json=_jsonable(params),
+                                       timeout=timeout) as response:
+            text = await response.text()
+        try:
+            data = json.loads(text)
+        except ValueError:
+            raise BadHTTPResponse(response.status, text, response)
+        if data['ok']:
+            return data['result']
+        raise TelegramError(data['description'], data['error_code'], data)
+
+
+class AsyncTeleRaid(TeleRaidCore):
+    def __init__(self):
+        super().__init__()
+        self.__client = AsyncTelegramClient(
+            self._bot_token, config.get('telegram_api_url'),
+            config.get('telegram_pool_size', 20))
+        self.__queue = None
+        self.__queue_size = config.get('queue_size', 10000)
+        self.__event_filter = EventFilter(self._filters)
+        self.__deduplicator = Deduplicator()
+        self.__accepted = 0
+        self.__rejected = 0
+        self.__votes = None
+        self.__tasks = set()
+        self.__outbox_ready = None
+        self.__profiler = Profiler()
+        gauge('teleraid_queue_depth', 'Webhook events waiting in the queue.',
+              lambda: self.__queue.qsize() if self.__queue else 0)
+        gauge('teleraid_pending_tasks', 'Telegram tasks in flight.',
+              lambda: len(self.__tasks))
+
+    async def run(self, host, port):
+        log.info("TeleRaid is running on asyncio...")
+        self.__queue = asyncio.Queue()
+        self.__votes = asyncio.Event()
+        self.__outbox_ready = asyncio.Event()
+        self.__reload_requested = asyncio.Event()
+        if hasattr(signal, 'SIGHUP'):
+            asyncio.get_event_loop().add_signal_handler(
+                signal.SIGHUP, self.__reload_requested.set)
+        await self.__client.start()
+
+        app = web.Application()
+        app.router.add_post('/', self.__accept_webhook)
+        app.router.add_post('/telegram/{secret}',
+                            self.__accept_telegram_update)
+        app.router.add_get('/stats', self.__stats)
+        app.router.add_get('/metrics', self.__metrics)
+        app.router.add_post('/admin/{secret}/profile', self.__profile)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+
+        try:
+            await asyncio.gather(self.__process_events(),
+                                 self.__update_messages(),
+                                 self.__send_outbox(),
+                                 self.__watch_config())
+        finally:
+            await runner.cleanup()
+            await self.__client.close()
+
+    def reload(self, new_config):
+        """Compiles the chats and geofences of a reloaded config, returns
+        the function putting them into effect."""
+        swap = super().reload(new_config)
+
+        def swap_both():
+            swap()
+            self.__event_filter.filters = self._filters
+        return swap_both
+
+    async def __watch_config(self):
+        # Configs are loaded and compiled in a thread, the loop only sees
+        # the finished filters
+        watcher = ConfigWatcher(config_path())
+        watcher.subscribe(self.reload)
+        interval = config.get('config_check_interval', 5)
+        loop = asyncio.get_event_loop()
+        while True:
+            try:
+                await asyncio.wait_for(self.__reload_requested.wait(),
+                                       interval or None)
+            except asyncio.TimeoutError:
+                pass
+            requested = self.__reload_requested.is_set()
+            self.__reload_requested.clear()
+            watcher.apply(await loop.run_in_executor(None, watcher.check,
+                                                     requested))
+
+    def __spawn(self, coroutine):
+        # The loop only keeps weak references to tasks
+        task = asyncio.ensure_future(coroutine)
+        self.__tasks.add(task)
+        task.add_done_callback(self.__tasks.discard)
+        return task
+
+    async def __accept_webhook(self, request):
+        try:
+            events = split_events(await request.read())
+        except ValueError as e:
+            log.warning("Received malformed webhook: {}".format(repr(e)))
+            return web.Response(status=400, text="Bad Request")
+
+        events = self.__deduplicator.check(
+            self.__event_filter.filter(events))
+        self._tracer.tag(events)
+        if 0 < self.__queue_size < self.__queue.qsize() + len(events):
+            self.__rejected += len(events)
+            EVENTS.add(len(events), 'rejected')
+            log.warning("Queue is full, rejected {} webhook events."
+                        .format(len(events)))
+            return web.Response(status=429, text="Too Many Requests", headers={
+                'Retry-After': str(config.get('queue_retry_after', 5))})
+
+        now = time()
+        for event in events:
+            self.__queue.put_nowait((now, event))
+        self.__deduplicator.commit(events)
+        self.__accepted += len(events)
+        EVENTS.add(len(events), 'accepted')
+        return web.Response(text="OK")
+
+    async def __accept_telegram_update(self, request):
+        if not hmac.compare_digest(request.path.encode('utf-8'),
+                                   self.webhook_path.encode('utf-8')):
+            return web.Response(status=404, text="Not Found")
+
+        try:
+            update = json.loads(await request.text())
+        except ValueError as e:
+            log.warning("Received malformed Telegram update: {}"
+                        .format(repr(e)))
+            return web.Response(status=400, text="Bad Request")
+
+        self._handle_updates([update])
+        self.__votes.set()
+        return web.Response(text="OK")
+
+    async def __stats(self, request):
+        return web.json_response({
+            'queue': {
+                'depth': self.__queue.qsize(),
+                'maxsize': self.__queue_size,
+                'accepted': self.__accepted,
+                'rejected': self.__rejected
+            },
+            'teleraid': self.stats(),
+            'ignored': self.__event_filter.ignored,
+            'duplicates': self.__deduplicator.duplicates
+        })
+
+    async def __metrics(self, request):
+        return web.Response(text=REGISTRY.render(),
+                            content_type='text/plain',
+                            headers={'X-Prometheus-Format': '0.0.4'})
+
+    async def __profile(self, request):
+        secret = config.get('admin_secret')
+        if not secret or not hmac.compare_digest(
+                request.match_info['secret'].encode('utf-8'),
+                secret.encode('utf-8')):
+            return web.Response(status=404, text="Not Found")
+
+        try:
+            seconds = min(float(request.query.get('seconds', 10)),
+                          MAX_PROFILE_SECONDS)
+        except ValueError:
+            return web.Response(status=400, text="Bad Request")
+        if not self.__profiler.start():
+            return web.Response(status=409, text="Already profiling")
+        log.info("Profiling for {:.0f}s.".format(seconds))
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            stats = self.__profiler.stop()
+        return web.Response(text=stats)
+
+    async def __process_events(self):
+        while True:
+            try:
+                enqueued, data_json = await asyncio.wait_for(
+                    self.__queue.get(), self._scheduler.timeout())
+            except asyncio.TimeoutError:
+                data_json = None
+
+            if data_json is not None:
+                QUEUE_WAIT.observe(time() - enqueued)
+                try:
+                    with STAGE_SECONDS.time('process_request'):
+                        self._process_request(data_json)
+                except Exception as e:
+                    log.exception("Exception during regular runtime: {}"
+                                  .format(repr(e)))
+
+            try:
+                with STAGE_SECONDS.time('run_scheduled'):
+                    self._run_scheduled()
+            except Exception as e:
+                log.exception("Exception while running scheduled events: {}"
+                              .format(repr(e)))
+
+    def _send(self, priority, key, function, *args, **kwargs):
+        super()._send(priority, key, function, *args, **kwargs)
+        self.__outbox_ready.set()
+
+    async def __send_outbox(self):
+        # Operations beyond one per pooled connection wait in the outbox,
+        # so the next free connection serves the most urgent one
+        slots = asyncio.Semaphore(config.get('telegram_pool_size', 20))
+        while True:
+            await slots.acquire()
+            op = self._outbox.pop()
+            while op is None:
+                try:
+                    await asyncio.wait_for(self.__outbox_ready.wait(),
+                                           self._outbox.timeout())
+                except asyncio.TimeoutError:
+                    pass
+                self.__outbox_ready.clear()
+                op = self._outbox.pop()
+            self.__spawn(self.__execute(op, slots))
+
+    async def __execute(self, op, slots):
+        try:
+            await op.function(*op.args)
+        except Exception as e:
+            self._outbox.fail(op, e)
+        else:
+            self._outbox.done(op)
+        finally:
+            slots.release()
+            # A retry may be due before anything else
+            self.__outbox_ready.set()
+
+    async def _send_notification(self, raid, subscription):
+        text, calls = self._notification(raid, subscription)
+        sent = []
+        try:
+            for method, params in calls:
+                sent.append(await self.__call(method, subscription.chat_id,
+                                              raid.trace, **params))
+        except Exception:
+            self._notification_failed(sent)
+            raise
+        self._notification_sent(raid, subscription, sent, text)
+
+    async def _sweep(self, chat_id):
+        message_ids = self._take_deletions(chat_id)
+        if not message_ids:
+            return
+        try:
+            await self.__delete_bulk(chat_id, message_ids)
+        except Exception:
+            self._return_deletions(chat_id, message_ids)
+            raise
+
+    async def __delete_bulk(self, chat_id, message_ids):
+        if self._bulk_delete:
+            try:
+                await self.__call('deleteMessages', chat_id, chat_id=chat_id,
+                                  message_ids=message_ids)
+                log.info("Deleted {} outdated messages."
+                         .format(len(message_ids)))
+                return
+            except TelegramError as e:
+                if not self._bulk_delete_failed(e):
+                    raise
+        for message_id in message_ids:
+            # Deleted already, or too old to be deleted by a bot
+            await self.__call_quietly('deleteMessage', chat_id,
+                                      "Message not deleted",
+                                      msg_identifier=(chat_id, message_id))
+        log.info("Deleted {} outdated messages.".format(len(message_ids)))
+
+    async def _edit_poll(self, key):
+        edit = self._poll_edit(key)
+        if edit is None:
+            return
+        message, rendered, method, params = edit
+        if await self.__call_quietly(method, key[0],
+                                     "No change in message after updating",
+                                     **params):
+            message.rendered = rendered
+
+    async def __update_messages(self):
+        edits = self.__spawn(self.__edit_polls())
+        if not (self._webhook_url and await self.__set_webhook()):
+            await self.__poll_updates()
+        await edits
+
+    async def __set_webhook(self):
+        try:
+            await self.__client.call(
+                'setWebhook',
+                url=self._webhook_url.rstrip('/') + self.webhook_path,
+                allowed_updates=['callback_query'])
+            log.info("Receiving Telegram updates via webhook.")
+            return True
+        except Exception as e:
+            log.exception("Exception while setting webhook, falling back to "
+                          "polling: {}".format(repr(e)))
+            return False
+
+    async def __poll_updates(self):
+        offset = None
+        retry_time = 1
+        try:
+            await self.__client.call('deleteWebhook')
+        except Exception as e:
+            log.exception("Exception while deleting webhook: {}"
+                          .format(repr(e)))
+
+        while True:
+            try:
+                # Long polling, Telegram answers as soon as there are votes
+                updates = await self.__client.call(
+                    'getUpdates', offset=offset, timeout=POLL_TIMEOUT,
+                    allowed_updates=['callback_query'])
+                self._handle_updates(updates)
+                for u in updates:
+                    update_id = u.get('update_id', None)
+                    if update_id and (offset is None or update_id >= offset):
+                        offset = update_id + 1
+                if updates:
+                    self.__votes.set()
+                retry_time = 1
+            except Exception as e:
+                log.exception("Exception while updating messages: {}"
+                              .format(repr(e)))
+                await asyncio.sleep(retry_time)
+                retry_time = min(retry_time * 2, 60)
+
+    async def __edit_polls(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.__votes.wait(),
+                                       self._poll_edits.timeout())
+            except asyncio.TimeoutError:
+                pass
+            self.__votes.clear()
+            self._queue_due_edits()
+
+    # Errors of the calls below reach the outbox, which retries the
+    # operation if they are transient
+
+    async def __call(self, method, chat, trace=None, **kwargs):
+        # Calls wait for the rate limiter and are retried when Telegram
+        # reports a flood wait, which only pauses the affected chat. Both
+        # end up in the `trace` of a notification.
+        for attempt in range(self._max_flood_retries + 1):
+            wait = self._limiter.delay(chat)
+            if wait > 0:
+                await asyncio.sleep(wait)
+            reserved = self._limiter.reserve(chat)
+            if reserved > 0:
+                await asyncio.sleep(reserved)
+                wait += reserved
+            start = time()
+            if trace is not None and wait > 0.001:
+                trace.add('throttled {}'.format(chat), start - wait, start)
+            try:
+                return await self.__client.call(method, **kwargs)
+            except Exception as e:
+                retry_after = self._flood_wait(method, e, attempt)
+                if retry_after is None:
+                    raise
+                self._limiter.pause(chat, retry_after)
+            finally:
+                TELEGRAM_SECONDS.observe(time() - start, method)
+                if trace is not None:
+                    trace.add('{} {}'.format(method, chat), start)
+
+    async def __call_quietly(self, method, chat, warning, **kwargs):
+        # Telegram rejects edits that change nothing and deletions of gone
+        # messages with 400, which is only logged
+        try:
+            return await self.__call(method, chat, **kwargs)
+        except TelegramError as e:
+            if e.error_code != 400:
+                raise
+            log.warning("TelegramError - {}: {}".format(warning,
+                                                        e.description))
+
+
+def run():
+    """Runs TeleRaid and its webhook server until interrupted."""
+    try:
+        asyncio.run(AsyncTeleRaid().run(config['host'], config['port']))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,71 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+from collections import OrderedDict
+from time import time
+
+
+class LRUCache(object):
+    """Dict-like cache evicting the least recently used key when full."""
+
+    def __init__(self, maxsize=1024):
+        self.__maxsize = maxsize
+        self.__data = OrderedDict()
+
+    def __len__(self):
+        return len(self.__data)
+
+    def __contains__(self, key):
+        return key in self.__data
+
+    def get(self, key, default=None):
+        try:
+            value = self.__data.pop(key)
+        except KeyError:
+            return default
+        self.__data[key] = value
+        return value
+
+    def set(self, key, value):
+        self.__data.pop(key, None)
+        self.__data[key] = value
+        if len(self.__data) > self.__maxsize:
+            self.__data.popitem(last=False)
+
+    def get_or_set(self, key, factory):
+        value = self.get(key)
+        if value is None:
+            value = factory()
+            self.set(key, value)
+        return value
+
+
+class TTLCache(object):
+    """Dict-like cache whose keys expire at a given point in time."""
+
+    def __init__(self, purge_interval=60):
+        self.__data = {}
+        self.__purge_interval = purge_interval
+        self.__next_purge = time() + purge_interval
+
+    def __len__(self):
+        return len(self.__data)
+
+    def get(self, key, default=None, now=None):
+        entry = self.__data.get(key)
+        if entry is None or entry[1] <= (now or time()):
+            return default
+        return entry[0]
+
+    def set(self, key, value, expires, now=None):
+        now = now or time()
+        self.__data[key] = (value, expires)
+        if now >= self.__next_purge:
+            self.purge(now)
+
+    def purge(self, now=None):
+        now = now or time()
+        expired = [k for k in self.__data if self.__data[k][1] <= now]
+        for key in expired:
+            del self.__data[key]
+        self.__next_purge = now + self.__purge_interval
@@ -0,0 +1,562 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Raid and message state shared by the gevent and asyncio engines.
+
+The engines subclass TeleRaidCore and add what differs between them: the
+Telegram client and the calls made with it, blocking or awaited, and how
+events, updates and outbox operations are waited for.
+"""
+
+import hashlib
+import logging
+
+from threading import RLock
+from time import time
+from telepot.exception import TelegramError
+
+# Custom files and packages
+from config.config import config
+from .debounce import Debouncer
+from .metrics import counter, gauge, histogram
+from .outbox import DELETE, EDIT, NOTIFY, Outbox
+from .ratelimit import RateLimiter
+from .scheduler import Scheduler
+from .registry import native_str
+from .routing import filters_from_config
+from .records import RAID_FIELDS, Message, Raid, SentIds
+from .store import get_store
+from .templates import RaidTemplate
+from .tracing import Tracer
+from .utils import telepot_shiny, get_sticker
+from .workers import Countdown
+
+log = logging.getLogger(__name__)
+
+STAGE_SECONDS = histogram('teleraid_stage_seconds',
+                          'Time spent in each processing stage.', ('stage',))
+TELEGRAM_SECONDS = histogram('teleraid_telegram_request_seconds',
+                             'Latency of Telegram API calls.', ('method',))
+TELEGRAM_ERRORS = counter('teleraid_telegram_errors_total',
+                          'Failed Telegram API calls.', ('method',))
+NOTIFICATIONS = counter('teleraid_notifications_total',
+                        'Raid notifications of a chat, by outcome.',
+                        ('result',))
+
+# Most messages Telegram deletes with one deleteMessages call
+MAX_BULK_DELETE = 100
+
+# Poll-only messages are forgotten after the 48 hours a bot may edit them
+POLL_ONLY_SECONDS = 48 * 3600
+
+# Sticker, location and text message, or everything in one venue or text
+# message with a map link
+NOTIFICATION_FORMATS = ('sticker', 'venue', 'text')
+
+
+class TeleRaidCore(object):
+    """Tracks raids, their messages and polls, and queues the Telegram
+    operations keeping them up to date in the outbox.
+
+    Subclasses implement `_send_notification`, `_sweep` and `_edit_poll`,
+    which the outbox runs, on top of `_notification`, `_take_deletions` and
+    `_poll_edit`.
+    """
+
+    def __init__(self, shard=None):
+        self._bot_token = config['bot_token']
+        self.__format = config.get('notification_format', 'sticker')
+        if self.__format not in NOTIFICATION_FORMATS:
+            raise ValueError("Unknown notification format {}."
+                             .format(self.__format))
+        # Replaced as a whole when the config is reloaded
+        self._filters = filters_from_config(config)
+
+        self.__raids = {}
+        self.__messages = {}
+        self.__gym_messages = {}
+        self._scheduler = Scheduler()
+        # Guards raids and messages shared with the outbox workers of the
+        # gevent engine
+        self._lock = RLock()
+        # Operations for a chat that is held back by the rate limiter wait
+        # in the outbox, not in a worker or connection other chats need
+        self._outbox = Outbox(config.get('outbox_max_attempts', 5),
+                              config.get('outbox_backoff', 1),
+                              hold=lambda op: self._limiter.delay(op.chat))
+        # Message IDs per chat waiting for the sweeper, which deletes them
+        # in bulk
+        self.__deletions = {}
+        self.__sweeping = set()
+        self.__delete_interval = config.get('delete_interval', 5)
+        self._bulk_delete = True
+        self.__template = RaidTemplate(
+            config.get('template_cache_size', 512),
+            '' if shard is None else ':{}'.format(shard))
+        self._poll_edits = Debouncer(config.get('poll_edit_interval', 3))
+        self._webhook_url = config.get('telegram_webhook_url')
+        self.webhook_path = '/telegram/' + config.get(
+            'telegram_webhook_secret',
+            hashlib.sha256(self._bot_token.encode('utf-8')).hexdigest())
+        self._limiter = RateLimiter(
+            global_rate=config.get('rate_limit_global', 30),
+            global_burst=config.get('rate_limit_global', 30),
+            chat_rate=config.get('rate_limit_chat', 20) / 60.0,
+            chat_burst=config.get('rate_limit_chat', 20))
+        self._max_flood_retries = config.get('max_flood_retries', 3)
+        self._tracer = Tracer(config.get('trace_slow_seconds', 10))
+
+        self.__store = get_store(config)
+        self.__restore()
+        self.__register_metrics()
+
+    def reload(self, new_config):
+        """Compiles the chats and geofences of a reloaded config, returns
+        the function putting them into effect."""
+        filters = filters_from_config(new_config)
+
+        def swap():
+            # Aliases learned while the config was compiled are kept
+            filters.router.adopt_aliases(self._filters.router)
+            self._filters = filters
+        return swap
+
+    def stats(self):
+        return {
+            'raids': len(self.__raids),
+            'messages': len(self.__messages),
+            'rate_limit': self._limiter.stats()
+        }
+
+    def _send(self, priority, key, function, *args, **kwargs):
+        self._outbox.put(priority, key, function, *args, **kwargs)
+
+    def _process_request(self, data_json):
+        trace = self._tracer.resume(data_json.get('trace'))
+        if trace is not None:
+            trace.step('queue')
+        raid = None
+        if data_json['type'] == 'raid':
+            log.debug("Raid received.")
+            raid = self.__add_raid(data_json['message'], trace)
+        if trace is not None:
+            trace.step('process')
+        if raid is None:
+            # Only events adding a raid are followed until it is notified
+            self._tracer.finish(trace, 'processed')
+
+    def __restore(self):
+        raids, messages, votes = self.__store.load()
+        for raid in raids:
+            self.__track_raid(raid)
+
+        now = time()
+        for chat_id, message_id, gym_id, ids, body, created in messages:
+            if not gym_id:
+                expires = (created or 0) + POLL_ONLY_SECONDS
+                if expires <= now:
+                    self.__store.delete_message(chat_id, message_id)
+                    continue
+                self._scheduler.schedule(expires, 'forget',
+                                         (chat_id, message_id))
+            # Raid messages render their body from the raid
+            if gym_id in self.__raids:
+                body = None
+            self.__add_message((chat_id, message_id), Message(
+                gym_id, body if body is None else native_str(body), ids))
+
+        for chat_id, message_id, user_id, username, data in votes:
+            message = self.__messages.get((chat_id, message_id))
+            if message:
+                message.vote(user_id, username, data)
+
+    def __add_raid(self, data, trace=None):
+        if not data['pokemon_id']:
+            return
+
+        known = self.__raids.get(data['gym_id'])
+        if known:
+            # Overlapping windows are the same raid, reported again
+            if (data['start'] < known.end and
+                    known.start < data['end']):
+                self.__merge_raid(known, data)
+                return
+            self.__expire_raid(data['gym_id'])
+
+        raid = Raid.from_webhook(data)
+        raid.trace = trace
+        self.__track_raid(raid)
+        self.__store.save_raid(raid)
+        log.info("Raid added.")
+        return raid
+
+    def __merge_raid(self, known, data):
+        changed = [f for f in RAID_FIELDS
+                   if f in data and data[f] != getattr(known, f)]
+        if not changed:
+            log.debug("Ignored duplicate raid.")
+            return
+
+        for field in changed:
+            setattr(known, field, data[field])
+        self.__track_raid(known)
+        self.__store.save_raid(known)
+        log.info("Raid updated ({}).".format(', '.join(changed)))
+        if known.notified:
+            self.__update_notification(known)
+
+    def __track_raid(self, raid):
+        self.__raids[raid.gym_id] = raid
+        if self.__match(raid):
+            self._scheduler.schedule(raid.start, 'hatch', raid.gym_id)
+        self._scheduler.schedule(raid.end, 'expire', raid.gym_id)
+
+    def __match(self, raid):
+        return self._filters.match(raid)
+
+    def _run_scheduled(self):
+        now = time()
+        for event, gym_id in self._scheduler.pop_due(now):
+            if event == 'forget':
+                # Keyed by the poll-only message, not by a gym
+                self.__forget_message(gym_id)
+                continue
+
+            raid = self.__raids.get(gym_id)
+            if raid is None:
+                continue
+
+            if event == 'hatch' and raid.start <= now:
+                if not raid.notified:
+                    log.info("Notifying about raid with Pokemon-ID {}."
+                             .format(raid.pokemon_id))
+                    # Flagged right away, a merge must not notify twice
+                    raid.notified = True
+                    self.__notify(raid)
+                else:
+                    log.debug("Already notified about raid of Pokemon-ID {}."
+                              .format(raid.pokemon_id))
+            elif event == 'expire' and raid.end <= now:
+                with STAGE_SECONDS.time('expire_raid'):
+                    self.__expire_raid(gym_id)
+
+    def __expire_raid(self, gym_id):
+        with self._lock:
+            raid = self.__raids.pop(gym_id)
+            self.__store.delete_raid(gym_id)
+            chats = self.__remove_gym_messages(gym_id)
+        # Notifications still waiting in the outbox are not sent at all
+        for subscription in self.__match(raid):
+            self._outbox.cancel(('notify', gym_id, subscription.chat_id))
+        for chat_id in chats:
+            ids = chats[chat_id]
+            self.__store.delete_message(chat_id, ids[-1])
+            self.__delete_messages(chat_id, ids)
+
+        log.debug("Raid expired.")
+
+    def __forget_message(self, key):
+        with self._lock:
+            self.__messages.pop(key, None)
+            self._poll_edits.forget(key)
+        self._outbox.cancel(('edit',) + key)
+        self.__store.delete_message(*key)
+
+    def __delete_messages(self, chat_id, message_ids):
+        # Pending edits of the notification's text are moot
+        self._outbox.cancel(('edit', chat_id, message_ids[-1]))
+        with self._lock:
+            self.__deletions.setdefault(chat_id, []).extend(message_ids)
+            if chat_id in self.__sweeping:
+                return
+            self.__sweeping.add(chat_id)
+        self.__schedule_sweep(chat_id, self.__delete_interval)
+
+    def __schedule_sweep(self, chat_id, delay):
+        # Messages expiring within `delay` are deleted together
+        self._send(DELETE, ('delete', chat_id), self._sweep, chat_id,
+                   delay=delay, chat=chat_id,
+                   finish=lambda result: self.__swept(chat_id, result))
+
+    def _take_deletions(self, chat_id):
+        """Returns the next messages of `chat_id` to delete in bulk."""
+        with self._lock:
+            backlog = self.__deletions.pop(chat_id, [])
+            if backlog[MAX_BULK_DELETE:]:
+                self.__deletions[chat_id] = backlog[MAX_BULK_DELETE:]
+        return backlog[:MAX_BULK_DELETE]
+
+    def _return_deletions(self, chat_id, message_ids):
+        """Puts messages whose deletion failed back in front of the
+        backlog."""
+        with self._lock:
+            self.__deletions[chat_id] = message_ids + \
+                self.__deletions.get(chat_id, [])
+
+    def __swept(self, chat_id, result):
+        with self._lock:
+            if result == 'done' and chat_id in self.__deletions:
+                self.__schedule_sweep(chat_id, 0)
+                return
+            self.__sweeping.discard(chat_id)
+            if result != 'done':
+                log.warning("Gave up deleting {} messages."
+                            .format(len(self.__deletions.pop(chat_id, []))))
+
+    def _bulk_delete_failed(self, error):
+        """Returns whether messages are to be deleted one by one after
+        deleteMessages failed with `error`."""
+        if error.error_code not in (400, 404):
+            return False
+        if error.error_code == 404:
+            # Bot API servers before 7.0
+            self._bulk_delete = False
+        log.warning("Bulk deletion failed, deleting messages one by one: {}"
+                    .format(error.description))
+        return True
+
+    def __add_message(self, key, message):
+        # Messages are keyed by (chat_id, message_id). Poll-only entries
+        # come without a gym and are not indexed.
+        with self._lock:
+            self.__messages[key] = message
+            if message.gym_id:
+                self.__gym_messages.setdefault(message.gym_id, {})[
+                    key[0]] = message.ids
+
+    def __remove_gym_messages(self, gym_id):
+        with self._lock:
+            chats = self.__gym_messages.pop(gym_id, {})
+            for chat_id in chats:
+                key = (chat_id, chats[chat_id][-1])
+                self.__messages.pop(key, None)
+                # Pending poll edits would only edit a deleted message
+                self._poll_edits.forget(key)
+        return chats
+
+    def __body(self, chat_id, message):
+        if message.body is not None:
+            return message.body
+        locale, timezone = self.__chat_settings(chat_id)
+        return self.__render(self.__raids[message.gym_id], locale, timezone)
+
+    def __render(self, raid, locale, timezone):
+        text = self.__template.body(raid, locale, timezone)
+        if self.__format == 'text':
+            text += self.__template.map_link(raid, locale)
+        return text
+
+    def __chat_settings(self, chat_id):
+        return self._filters.settings(chat_id)
+
+    def __notify(self, raid):
+        # Every chat is notified through the outbox, the raid counts as
+        # notified once all of them are finished
+        subscriptions = self.__match(raid)
+        start = time()
+        trace = raid.trace
+        if trace is not None:
+            trace.step('scheduled')
+
+        def notified():
+            STAGE_SECONDS.observe(time() - start, 'notify')
+            self._tracer.finish(trace, 'notified')
+            raid.trace = None
+            with self._lock:
+                if self.__raids.get(raid.gym_id) is raid:
+                    self.__store.save_raid(raid)
+
+        countdown = Countdown(len(subscriptions), notified)
+
+        def finish(result):
+            NOTIFICATIONS.inc('sent' if result == 'done' else result)
+            countdown.done()
+
+        for subscription in subscriptions:
+            self._send(NOTIFY, ('notify', raid.gym_id, subscription.chat_id),
+                       self._send_notification, raid, subscription,
+                       finish=finish, chat=subscription.chat_id)
+        if not subscriptions:
+            notified()
+
+    def _notification(self, raid, subscription):
+        """Returns the text of a notification and the Bot API calls sending
+        it, as (method, parameters) in the order they are to be made."""
+        chat_id = subscription.chat_id
+        text = self.__render(raid, subscription.locale, subscription.timezone)
+        keyboard_markup = self.__template.keyboard(
+            locale=subscription.locale)
+        trace = raid.trace
+        if trace is not None:
+            trace.add('outbox {}'.format(chat_id), trace.mark)
+
+        message = ('sendMessage', dict(
+            chat_id=chat_id, text=text, parse_mode="HTML",
+            reply_markup=keyboard_markup))
+        if self.__format == 'venue':
+            title, address = self.__template.venue(
+                raid, subscription.locale, subscription.timezone)
+            return text, [('sendVenue', dict(
+                chat_id=chat_id, latitude=raid.latitude,
+                longitude=raid.longitude, title=title, address=address,
+                reply_markup=keyboard_markup))]
+        if self.__format == 'text':
+            return text, [message]
+        # Sticker, location and text go out in order, each only after the
+        # previous one arrived
+        return text, [
+            ('sendSticker', dict(chat_id=chat_id,
+                                 sticker=get_sticker(raid.pokemon_id))),
+            ('sendLocation', dict(chat_id=chat_id, latitude=raid.latitude,
+                                  longitude=raid.longitude)),
+            message]
+
+    def _notification_failed(self, sent):
+        # Nothing would ever delete the parts that made it, a retry sends
+        # the whole notification again
+        if sent:
+            log.warning("Incomplete notification, deleting {} sent "
+                        "message(s).".format(len(sent)))
+            self.__delete_messages(sent[0]['chat']['id'],
+                                   [m['message_id'] for m in sent])
+
+    def _notification_sent(self, raid, subscription, sent, text):
+        chat_id = sent[-1]['chat']['id']
+        self._filters.router.alias(chat_id, subscription)
+        ids = tuple(m['message_id'] for m in sent)
+        if len(ids) > 1:
+            ids = SentIds(*ids)
+        with self._lock:
+            current = self.__raids.get(raid.gym_id) is raid
+            if current:
+                self.__add_message((chat_id, ids[-1]),
+                                   Message(raid.gym_id, ids=ids))
+                self.__store.save_message(chat_id, ids[-1],
+                                          raid.gym_id, ids, text)
+        if not current:
+            # Expired while the messages were on their way
+            self.__delete_messages(chat_id, ids)
+
+    def __update_notification(self, raid):
+        with self._lock:
+            chats = dict(self.__gym_messages.get(raid.gym_id, {}))
+        for chat_id in chats:
+            key = (chat_id, chats[chat_id][-1])
+            message = self.__messages.get(key)
+            if message is None:
+                continue
+            self.__store.save_message(chat_id, key[1], raid.gym_id,
+                                      chats[chat_id],
+                                      self.__body(chat_id, message))
+            self.__queue_edit(key)
+
+    def _handle_updates(self, updates):
+        # Updates are handled one by one, a malformed one must not cost
+        # the others their votes
+        for u in updates:
+            try:
+                self.__handle_update(u)
+            except Exception as e:
+                log.exception("Exception while handling update {}: {}"
+                              .format(u.get('update_id'), repr(e)))
+
+    def __handle_update(self, u):
+        callback_query = u.get('callback_query', {})
+        data = callback_query.get('data', None)
+        message = callback_query.get('message', {})
+        message_id = message.get('message_id', 0)
+        if not message_id:
+            return
+
+        chat_id = message['chat']['id']
+        key = (chat_id, message_id)
+        if key not in self.__messages:
+            # Unknown messages (e.g. sent before a restart) keep their text
+            # up to an existing poll footer as body
+            body = telepot_shiny(message).split('\n\n<b>Yes</b>')[0]
+            self.__add_message(key, Message(body=native_str(body)))
+            self.__store.save_message(chat_id, message_id, '', None, body)
+            self._scheduler.schedule(time() + POLL_ONLY_SECONDS, 'forget',
+                                     key)
+
+        user = callback_query['from']
+        # Not every Telegram user has a username
+        name = user.get('username') or user.get('first_name', '')
+        self.__messages[key].vote(user['id'], name, data)
+        self.__store.save_vote(chat_id, message_id, user['id'], name, data)
+        self._poll_edits.touch(key)
+
+    def _queue_due_edits(self):
+        for key in self._poll_edits.pop_due():
+            self.__queue_edit(key)
+
+    def __queue_edit(self, key):
+        # A newer edit supersedes a pending one, both render the latest
+        # state of the message
+        self._send(EDIT, ('edit',) + key, self._edit_poll, key,
+                   chat=key[0])
+
+    def _poll_edit(self, key):
+        """Returns the message at `key`, its rendering after the edit and
+        the Bot API call making it, or None if nothing changed."""
+        message = self.__messages.get(key)
+        if message is None:
+            return None
+
+        locale = self.__chat_settings(key[0])[0]
+        tally = message.tally()
+        if self.__format == 'venue':
+            # Venues have no text to edit, only the counts of their buttons
+            # change
+            rendered = hash(tally)
+            method, params = 'editMessageReplyMarkup', {}
+        else:
+            text = self.__body(key[0], message)
+            if any(tally):
+                text += self.__template.footer(message.votes, locale)
+            # Votes that cancel out render the same message again. Only a
+            # hash of the rendering is kept, not the text itself.
+            rendered = hash((text, tally))
+            method, params = 'editMessageText', {'text': text,
+                                                 'parse_mode': 'HTML'}
+        if rendered == message.rendered:
+            log.debug("Message unchanged, skipped editing it.")
+            return None
+
+        params.update(msg_identifier=key,
+                      reply_markup=self.__template.keyboard(
+                          tally if any(tally) else None, locale))
+        return message, rendered, method, params
+
+    def _flood_wait(self, method, error, attempt):
+        """Returns the seconds Telegram asked to wait before the failed call
+        is retried, None if `error` is to be raised."""
+        TELEGRAM_ERRORS.inc(method)
+        if not isinstance(error, TelegramError):
+            return None
+        retry_after = (error.json or {}).get('parameters', {}).get(
+            'retry_after')
+        if (error.error_code != 429 or not retry_after or
+                attempt == self._max_flood_retries):
+            return None
+        return retry_after
+
+    def __register_metrics(self):
+        gauge('teleraid_active_raids', 'Raids currently tracked.',
+              lambda: len(self.__raids))
+        gauge('teleraid_messages', 'Raid messages currently tracked.',
+              lambda: len(self.__messages))
+        gauge('teleraid_outbox_pending',
+              'Telegram operations waiting to be sent or retried.',
+              lambda: len(self._outbox))
+        gauge('teleraid_deletion_backlog', 'Messages waiting to be deleted.',
+              lambda: sum(len(ids)
+                          for ids in list(self.__deletions.values())))
+        gauge('teleraid_poll_voters', 'Votes on all tracked polls.',
+              lambda: sum(len(m.votes or ())
+                          for m in list(self.__messages.values())))
+        counter('teleraid_throttled_seconds_total',
+                'Time Telegram calls waited for the rate limiter.',
+                function=lambda: self._limiter.throttled_seconds)
+        counter('teleraid_flood_waits_total',
+                'Flood waits Telegram asked for.',
+                function=lambda: self._limiter.flood_waits)
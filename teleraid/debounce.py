@@ -0,0 +1,49 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+from time import time
+
+
+class Debouncer(object):
+    """Lets each key fire at most once per `interval` seconds.
+
+    The first touch of a quiet key is due immediately, further touches
+    within the interval are coalesced into one firing at its end.
+    """
+
+    def __init__(self, interval):
+        self.__interval = interval
+        self.__last = {}
+        self.__pending = {}
+
+    def touch(self, key, now=None):
+        if key not in self.__pending:
+            now = now or time()
+            self.__pending[key] = max(
+                now, self.__last.get(key, 0) + self.__interval)
+
+    def forget(self, key):
+        """Drops a pending firing and the history of `key`."""
+        self.__pending.pop(key, None)
+        self.__last.pop(key, None)
+
+    def timeout(self, now=None):
+        """Seconds until the next key is due, None if nothing is pending."""
+        if not self.__pending:
+            return None
+        return max(0, min(self.__pending.values()) - (now or time()))
+
+    def pop_due(self, now=None):
+        now = now or time()
+        due = [k for k in self.__pending if self.__pending[k] <= now]
+        for key in due:
+            del self.__pending[key]
+            self.__last[key] = now
+
+        # Keys that have been quiet for a whole interval need no history
+        quiet = [k for k in self.__last
+                 if self.__last[k] + self.__interval <= now and
+                 k not in self.__pending]
+        for key in quiet:
+            del self.__last[key]
+        return due
@@ -0,0 +1,144 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+import math
+
+from .cache import LRUCache
+
+log = logging.getLogger(__name__)
+
+METERS_PER_DEGREE = 111320.0
+
+
+class Polygon(object):
+    def __init__(self, name, points):
+        self.name = name
+        self.points = [(float(lat), float(lon)) for lat, lon in points]
+        lats = [p[0] for p in self.points]
+        lons = [p[1] for p in self.points]
+        self.bbox = (min(lats), min(lons), max(lats), max(lons))
+
+    def contains(self, lat, lon):
+        # Ray casting, counts edges crossed by a ray to the east of the point
+        inside = False
+        points = self.points
+        j = len(points) - 1
+        for i in range(len(points)):
+            lat_i, lon_i = points[i]
+            lat_j, lon_j = points[j]
+            if ((lat_i > lat) != (lat_j > lat) and
+                    lon < (lon_j - lon_i) * (lat - lat_i) /
+                    (lat_j - lat_i) + lon_i):
+                inside = not inside
+            j = i
+        return inside
+
+
+class Circle(object):
+    def __init__(self, name, center, radius):
+        self.name = name
+        self.lat, self.lon = float(center[0]), float(center[1])
+        self.radius = float(radius)
+        self.__lon_scale = math.cos(math.radians(self.lat))
+        d_lat = self.radius / METERS_PER_DEGREE
+        d_lon = d_lat / max(self.__lon_scale, 1e-6)
+        self.bbox = (self.lat - d_lat, self.lon - d_lon,
+                     self.lat + d_lat, self.lon + d_lon)
+
+    def contains(self, lat, lon):
+        # Equirectangular distance is exact enough at neighborhood scale
+        d_lat = (lat - self.lat) * METERS_PER_DEGREE
+        d_lon = (lon - self.lon) * METERS_PER_DEGREE * self.__lon_scale
+        return d_lat * d_lat + d_lon * d_lon <= self.radius * self.radius
+
+
+class GeofenceIndex(object):
+    """Uniform grid over the bounding boxes of all geofences.
+
+    A point is only tested against the fences registered in its grid cell
+    whose bounding box contains it. Results are cached per gym.
+    """
+
+    def __init__(self, fences, cell_size=0.01, cache_size=100000):
+        self.fences = tuple(fences)
+        self.__cell_size = float(cell_size)
+        self.__grid = {}
+        self.__gyms = LRUCache(cache_size)
+        for fence in self.fences:
+            lat_min, lon_min = self.__cell(fence.bbox[0], fence.bbox[1])
+            lat_max, lon_max = self.__cell(fence.bbox[2], fence.bbox[3])
+            for i in range(lat_min, lat_max + 1):
+                for j in range(lon_min, lon_max + 1):
+                    self.__grid.setdefault((i, j), []).append(fence)
+
+    def __cell(self, lat, lon):
+        return (int(math.floor(lat / self.__cell_size)),
+                int(math.floor(lon / self.__cell_size)))
+
+    def fences_at(self, lat, lon):
+        """Returns the names of all fences containing the point."""
+        return frozenset(
+            f.name for f in self.__grid.get(self.__cell(lat, lon), ())
+            if f.bbox[0] <= lat <= f.bbox[2] and
+            f.bbox[1] <= lon <= f.bbox[3] and f.contains(lat, lon))
+
+    def classify(self, gym_id, lat, lon):
+        """Like fences_at, but remembers the result for `gym_id`."""
+        names = self.__gyms.get(gym_id)
+        if names is None:
+            names = self.fences_at(lat, lon)
+            self.__gyms.set(gym_id, names)
+        return names
+
+
+def parse_geofences(geofences):
+    """Builds fences from their config representation.
+
+    Every name maps either to a list of [lat, lon] points forming a polygon
+    or to a dict with 'center' ([lat, lon]) and 'radius' (meters).
+    """
+    fences = []
+    for name in geofences:
+        fence = geofences[name]
+        if isinstance(fence, dict):
+            fences.append(Circle(name, fence['center'], fence['radius']))
+        else:
+            fences.append(Polygon(name, fence))
+    return fences
+
+
+def read_geofence_file(file_path):
+    """Reads geofences from a JSON file or a RocketMap style text file.
+
+    The text format has a '[name]' line followed by one 'lat,lon' line per
+    polygon point.
+    """
+    with open(file_path, 'r') as f:
+        content = f.read()
+    if content.lstrip().startswith('{'):
+        return parse_geofences(json.loads(content))
+
+    geofences = {}
+    name = None
+    for line in content.splitlines():
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        if line.startswith('['):
+            name = line.strip('[]')
+            geofences[name] = []
+        elif name is not None:
+            lat, lon = line.split(',')
+            geofences[name].append((lat, lon))
+    return parse_geofences(geofences)
+
+
+def geofences_from_config(config):
+    fences = parse_geofences(config.get('geofences') or {})
+    if config.get('geofence_file'):
+        fences += read_geofence_file(config['geofence_file'])
+    if fences:
+        log.info("Loaded {} geofences.".format(len(fences)))
+    return GeofenceIndex(fences, config.get('geofence_cell_size', 0.01))
@@ -0,0 +1,204 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+
+from time import time
+
+try:
+    import Queue
+except ImportError:
+    import queue as Queue
+
+try:
+    # Decodes webhook bodies several times faster than the json module
+    from orjson import loads as _loads
+except ImportError:
+    from json import loads as _loads
+
+from .cache import TTLCache
+from .metrics import counter, histogram
+from .records import Raid
+from .routing import filters_from_config
+
+log = logging.getLogger(__name__)
+
+EVENTS = counter('teleraid_webhook_events_total',
+                 'Webhook events received, by outcome.', ('result',))
+QUEUE_WAIT = histogram('teleraid_queue_wait_seconds',
+                       'Time events spent in the queue.')
+
+# Raid fields whose change makes a webhook more than a duplicate
+RAID_FINGERPRINT = ('level', 'pokemon_id', 'move_1', 'move_2', 'latitude',
+                    'longitude')
+
+
+try:
+    # Recent gevent versions patch Queue.Queue, EventQueue builds on the
+    # standard library's implementation
+    from gevent.monkey import get_original
+    _Queue = get_original(Queue.__name__, 'Queue')
+except ImportError:
+    _Queue = Queue.Queue
+
+
+class EventQueue(_Queue):
+    """Bounded queue of webhook events with all-or-nothing bulk puts.
+
+    A batch that does not fit completely is rejected as a whole, so the
+    sender can safely retry the full POST without producing duplicates.
+    """
+
+    def __init__(self, maxsize=0):
+        _Queue.__init__(self, maxsize)
+        self.accepted = 0
+        self.rejected = 0
+
+    def _put(self, item):
+        self.queue.append((time(), item))
+
+    def _get(self):
+        enqueued, item = self.queue.popleft()
+        QUEUE_WAIT.observe(time() - enqueued)
+        return item
+
+    def put_many(self, items, accepted=None):
+        """Queues all `items` or, raising Queue.Full, none of them. Calls
+        `accepted` with the items once they are queued."""
+        with self.not_full:
+            if 0 < self.maxsize < self._qsize() + len(items):
+                self.rejected += len(items)
+                EVENTS.add(len(items), 'rejected')
+                raise Queue.Full
+            for item in items:
+                self._put(item)
+            self.unfinished_tasks += len(items)
+            self.accepted += len(items)
+            EVENTS.add(len(items), 'accepted')
+            self.not_empty.notify(len(items))
+        if accepted is not None:
+            accepted(items)
+
+    def stats(self):
+        with self.mutex:
+            return {
+                'depth': self._qsize(),
+                'maxsize': self.maxsize,
+                'accepted': self.accepted,
+                'rejected': self.rejected
+            }
+
+
+def split_events(body):
+    """Decode a webhook body into a list of events.
+
+    RocketMap-style scanners either post a single event object or a JSON
+    array of mixed events.
+    """
+    data = _loads(body)
+    if isinstance(data, dict):
+        return [data]
+    if isinstance(data, list):
+        return [e for e in data if isinstance(e, dict)]
+    raise ValueError("Unexpected webhook payload of type {}."
+                     .format(type(data).__name__))
+
+
+class EventFilter(object):
+    """Drops events TeleRaid would ignore before they are queued.
+
+    Scanners post every gym, pokestop and Pokemon they see, of which only
+    raids with a known boss matching a subscription are of interest. Raids
+    whose fields do not allow matching are passed on unchanged. `filters`
+    is replaced when the config is reloaded.
+    """
+
+    def __init__(self, filters):
+        self.filters = filters
+        self.ignored = 0
+
+    def reload(self, config):
+        """Compiles the filters of a reloaded config, returns the function
+        putting them into effect."""
+        filters = filters_from_config(config)
+
+        def swap():
+            filters.router.adopt_aliases(self.filters.router)
+            self.filters = filters
+        return swap
+
+    def filter(self, events):
+        filters = self.filters
+        wanted = [e for e in events if self.__wanted(e, filters)]
+        ignored = len(events) - len(wanted)
+        if ignored:
+            self.ignored += ignored
+            EVENTS.add(ignored, 'ignored')
+        return wanted
+
+    def __wanted(self, event, filters):
+        message = event.get('message')
+        if event.get('type') != 'raid' or not isinstance(message, dict):
+            return False
+        if not message.get('pokemon_id'):
+            return False
+        try:
+            return bool(filters.match(Raid.from_webhook(message)))
+        except (TypeError, ValueError):
+            return True
+
+
+class Deduplicator(object):
+    """Drops raid events that were already seen with identical data.
+
+    Raids are remembered by gym and raid window until the raid ends, so
+    scanners reporting the same raid over and over only get the first
+    report and later ones with changed data through.
+    """
+
+    def __init__(self, max_ttl=3 * 3600):
+        self.__seen = TTLCache()
+        self.__max_ttl = max_ttl
+        self.duplicates = 0
+
+    def check(self, events):
+        """Returns the events not seen before, without remembering them.
+
+        Only `commit` remembers raids, once the queue accepted them, so the
+        retry of a rejected batch is not dropped as a duplicate.
+        """
+        now = time()
+        unique = []
+        batch = {}
+        for event in events:
+            raid = self.__identify(event, now)
+            if raid is not None:
+                key, fingerprint, _ = raid
+                if fingerprint in (batch.get(key),
+                                   self.__seen.get(key, now=now)):
+                    self.duplicates += 1
+                    EVENTS.inc('duplicate')
+                    continue
+                batch[key] = fingerprint
+            unique.append(event)
+        return unique
+
+    def commit(self, events):
+        """Remembers the raids of checked events the queue accepted."""
+        now = time()
+        for event in events:
+            raid = self.__identify(event, now)
+            if raid is not None:
+                self.__seen.set(raid[0], raid[1], raid[2], now=now)
+
+    def __identify(self, event, now):
+        """Returns the key, fingerprint and expiry of a raid event."""
+        if event.get('type') != 'raid':
+            return None
+        raid = event.get('message') or {}
+        try:
+            key = (raid['gym_id'], raid['start'], raid['end'])
+            expires = min(float(raid['end']), now + self.__max_ttl)
+        except (KeyError, TypeError, ValueError):
+            return None
+        return key, tuple(raid.get(f) for f in RAID_FINGERPRINT), expires
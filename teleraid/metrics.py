@@ -0,0 +1,151 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+from bisect import bisect_left
+from time import time
+
+# Latency buckets in seconds, from cheap in-process stages to slow API calls
+BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+           2.5, 5.0, 10.0, 30.0)
+
+
+class Metric(object):
+    """Base of all metrics, each label value combination is one series.
+
+    Updates are plain dict operations without locking. Greenlets and the
+    GIL make them safe enough for monitoring purposes. Metrics without
+    labels can instead read their value from `function` when scraped.
+    """
+
+    TYPE = 'untyped'
+
+    def __init__(self, name, documentation, labels=(), function=None):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.function = function
+        self.values = {}
+
+    def samples(self):
+        if self.function is not None:
+            self.values[()] = self.function()
+        for key in sorted(self.values):
+            yield self.name, self.__labels(key), self.values[key]
+
+    def __labels(self, key):
+        return dict(zip(self.labels, key))
+
+
+class Counter(Metric):
+    TYPE = 'counter'
+
+    def inc(self, *labels):
+        self.values[labels] = self.values.get(labels, 0) + 1
+
+    def add(self, amount, *labels):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    TYPE = 'gauge'
+
+    def set(self, value):
+        self.values[()] = value
+
+
+class Histogram(Metric):
+    TYPE = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=BUCKETS):
+        Metric.__init__(self, name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        series = self.values.get(labels)
+        if series is None:
+            # Per bucket counts, then sum and count
+            series = self.values[labels] = [0] * (len(self.buckets) + 3)
+        series[bisect_left(self.buckets, value)] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def time(self, *labels):
+        return _Timer(self, labels)
+
+    def samples(self):
+        for key in sorted(self.values):
+            labels = dict(zip(self.labels, key))
+            series = self.values[key]
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), series):
+                cumulative += count
+                le = dict(labels, le='+Inf' if bound == float('inf')
+                          else repr(bound))
+                yield self.name + '_bucket', le, cumulative
+            yield self.name + '_sum', labels, series[-2]
+            yield self.name + '_count', labels, series[-1]
+
+
+class _Timer(object):
+    def __init__(self, histogram, labels):
+        self.__histogram = histogram
+        self.__labels = labels
+
+    def __enter__(self):
+        self.__start = time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.__histogram.observe(time() - self.__start, *self.__labels)
+
+
+class Registry(object):
+    def __init__(self):
+        self.__metrics = {}
+
+    def register(self, metric):
+        # Re-registering a name replaces the metric, e.g. on re-creation of
+        # the object it reports about
+        self.__metrics[metric.name] = metric
+        return metric
+
+    def render(self):
+        """Returns all metrics in the Prometheus text exposition format."""
+        lines = []
+        for name in sorted(self.__metrics):
+            metric = self.__metrics[name]
+            lines.append('# HELP {} {}'.format(name, metric.documentation))
+            lines.append('# TYPE {} {}'.format(name, metric.TYPE))
+            for sample, labels, value in metric.samples():
+                if labels:
+                    sample += '{' + ','.join(
+                        '{}="{}"'.format(k, _escape(labels[k]))
+                        for k in sorted(labels)) + '}'
+                lines.append('{} {}'.format(sample, _number(value)))
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(value):
+    return (str(value).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+def _number(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+REGISTRY = Registry()
+
+
+def counter(name, documentation, labels=(), function=None):
+    return REGISTRY.register(Counter(name, documentation, labels, function))
+
+
+def gauge(name, documentation, function=None):
+    return REGISTRY.register(Gauge(name, documentation, function=function))
+
+
+def histogram(name, documentation, labels=(), buckets=BUCKETS):
+    return REGISTRY.register(Histogram(name, documentation, labels, buckets))
@@ -0,0 +1,206 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import heapq
+import itertools
+import logging
+import random
+
+from time import time
+from threading import Condition, Lock
+from telepot.exception import TelegramError
+
+from .metrics import counter
+
+log = logging.getLogger(__name__)
+
+OPERATIONS = counter('teleraid_outbox_operations_total',
+                     'Telegram operations of the outbox, by outcome.',
+                     ('result',))
+
+# Priorities, lower ones are sent first
+NOTIFY, EDIT, DELETE = 0, 1, 2
+
+
+def is_transient(error):
+    """Whether a failed Telegram call may succeed when retried."""
+    if not isinstance(error, TelegramError):
+        return True
+    return error.error_code == 429 or error.error_code >= 500
+
+
+class Operation(object):
+    __slots__ = ('priority', 'key', 'function', 'args', 'finish', 'chat',
+                 'attempts', 'running', 'cancelled')
+
+    def __init__(self, priority, key, function, args, finish, chat=None):
+        self.priority = priority
+        self.key = key
+        self.function = function
+        self.args = args
+        self.finish = finish
+        self.chat = chat
+        self.attempts = 0
+        self.running = False
+        self.cancelled = False
+
+
+class Outbox(object):
+    """Pending Telegram operations, sent by priority.
+
+    Operations are identified by a key. Putting an operation cancels a
+    pending one with the same key, e.g. an older edit of the same message.
+    Failed operations are retried after an exponential backoff with
+    jitter, unless the error is permanent or they were cancelled in the
+    meantime. `finish` of an operation is called once with 'done',
+    'failed' or 'cancelled'; an operation cancelled while it runs finishes
+    with its outcome.
+
+    Operations put with a `delay` become due only after it passed. Worker
+    threads block in `get`, event loops use `pop` and `timeout`. `hold`
+    returns the seconds an operation due now is still held back, e.g. for
+    the rate limit of its `chat`; it is put back instead of handed out.
+    """
+
+    def __init__(self, max_attempts=5, backoff=1.0, max_backoff=60.0,
+                 hold=None):
+        self.__max_attempts = max_attempts
+        self.__backoff = backoff
+        self.__max_backoff = max_backoff
+        self.__hold = hold
+        self.__ready = []
+        self.__delayed = []
+        self.__pending = {}
+        self.__counter = itertools.count()
+        self.__random = random.Random()
+        self.__changed = Condition(Lock())
+
+    def __len__(self):
+        return len(self.__pending)
+
+    def put(self, priority, key, function, *args, **kwargs):
+        op = Operation(priority, key, function, args, kwargs.get('finish'),
+                       kwargs.get('chat'))
+        delay = kwargs.get('delay', 0)
+        with self.__changed:
+            cancelled = self.__cancel(key)
+            self.__pending[key] = op
+            if delay > 0:
+                heapq.heappush(self.__delayed,
+                               (time() + delay, next(self.__counter), op))
+            else:
+                heapq.heappush(self.__ready,
+                               (priority, next(self.__counter), op))
+            self.__changed.notify()
+        self.__finish(cancelled, 'cancelled')
+        return op
+
+    def cancel(self, key):
+        """Cancels the pending operation with `key`, if any."""
+        with self.__changed:
+            cancelled = self.__cancel(key)
+        self.__finish(cancelled, 'cancelled')
+
+    def __cancel(self, key):
+        # Returns the operation to finish as cancelled
+        op = self.__pending.pop(key, None)
+        if op is None:
+            return None
+        op.cancelled = True
+        return None if op.running else op
+
+    def timeout(self, now=None):
+        """Seconds until the next operation is due, None if there is
+        none."""
+        with self.__changed:
+            return self.__timeout(now or time())
+
+    def __timeout(self, now):
+        if self.__ready:
+            return 0
+        if self.__delayed:
+            return max(0, self.__delayed[0][0] - now)
+        return None
+
+    def pop(self, now=None):
+        """Returns the next due operation, None if there is none."""
+        with self.__changed:
+            return self.__pop(now or time())
+
+    def __pop(self, now):
+        while self.__delayed and self.__delayed[0][0] <= now:
+            op = heapq.heappop(self.__delayed)[2]
+            heapq.heappush(self.__ready,
+                           (op.priority, next(self.__counter), op))
+        while self.__ready:
+            op = heapq.heappop(self.__ready)[2]
+            if op.cancelled:
+                continue
+            wait = self.__hold(op) if self.__hold is not None else 0
+            if wait > 0:
+                heapq.heappush(self.__delayed,
+                               (now + wait, next(self.__counter), op))
+                continue
+            op.running = True
+            return op
+        return None
+
+    def get(self):
+        """Blocks until an operation is due and returns it."""
+        with self.__changed:
+            while True:
+                now = time()
+                op = self.__pop(now)
+                if op is not None:
+                    return op
+                self.__changed.wait(self.__timeout(now))
+
+    def execute(self, op):
+        """Runs a synchronous operation."""
+        try:
+            op.function(*op.args)
+        except Exception as e:
+            self.fail(op, e)
+        else:
+            self.done(op)
+
+    def done(self, op):
+        with self.__changed:
+            op.running = False
+            if not op.cancelled:
+                del self.__pending[op.key]
+        self.__finish(op, 'done')
+
+    def fail(self, op, error):
+        """Schedules a retry of `op`, or gives up on it."""
+        op.attempts += 1
+        with self.__changed:
+            op.running = False
+            if not op.cancelled and is_transient(error) and \
+                    op.attempts < self.__max_attempts:
+                delay = min(self.__max_backoff,
+                            self.__backoff * 2 ** (op.attempts - 1))
+                delay *= self.__random.uniform(0.5, 1.5)
+                heapq.heappush(self.__delayed,
+                               (time() + delay, next(self.__counter), op))
+                self.__changed.notify()
+                OPERATIONS.inc('retried')
+                log.warning("Telegram operation {} failed, retrying in "
+                            "{:.1f}s: {}".format(op.key, delay, repr(error)))
+                return
+            if not op.cancelled:
+                del self.__pending[op.key]
+        log.error("Telegram operation {} failed after {} attempt(s): {}"
+                  .format(op.key, op.attempts, repr(error)))
+        self.__finish(op, 'failed')
+
+    def __finish(self, op, result):
+        if op is None:
+            return
+        OPERATIONS.inc(result)
+        if op.finish is not None:
+            try:
+                op.finish(result)
+            except Exception as e:
+                log.exception("Exception while finishing operation {}: {}"
+                              .format(op.key, repr(e)))
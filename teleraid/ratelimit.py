@@ -0,0 +1,119 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+
+from time import sleep, time
+from threading import Lock
+
+log = logging.getLogger(__name__)
+
+
+class TokenBucket(object):
+    """Token bucket in its virtual scheduling form.
+
+    Instead of counting tokens, the bucket remembers the theoretical
+    arrival time of the next call, which lets callers reserve a slot in the
+    future and simply wait for it.
+    """
+
+    def __init__(self, rate, burst=1):
+        self.__interval = 1.0 / rate
+        self.__tolerance = (max(burst, 1) - 1) * self.__interval
+        self.__tat = 0.0
+
+    def available(self, at):
+        """Return the start time of a call at or after `at`, without
+        reserving it."""
+        return max(at, self.__tat - self.__tolerance)
+
+    def reserve(self, at):
+        """Reserve one call at or after `at` and return its start time."""
+        start = max(at, self.__tat - self.__tolerance)
+        self.__tat = max(self.__tat, start) + self.__interval
+        return start
+
+
+class RateLimiter(object):
+    """Global plus per-chat rate limits shared by all Telegram calls."""
+
+    def __init__(self, global_rate=30, global_burst=30,
+                 chat_rate=20 / 60.0, chat_burst=20):
+        self.__global = TokenBucket(global_rate, global_burst)
+        self.__chat_rate = chat_rate
+        self.__chat_burst = chat_burst
+        self.__chats = {}
+        self.__paused = {}
+        self.__lock = Lock()
+
+        self.throttled_calls = 0
+        self.throttled_seconds = 0.0
+        self.flood_waits = 0
+
+    def acquire(self, chat_id):
+        """Block until a call to `chat_id` may be made."""
+        wait = self.delay(chat_id)
+        if wait > 0:
+            sleep(wait)
+        wait = self.reserve(chat_id)
+        if wait > 0:
+            sleep(wait)
+
+    def delay(self, chat_id):
+        """Return the seconds until a call to `chat_id` is due, without
+        reserving it.
+
+        Callers wait for the chat first and reserve only then, so a chat
+        held back by its own limit or a flood wait takes no share of the
+        global limit from the others.
+        """
+        with self.__lock:
+            now = time()
+            start = max(now, self.__paused.get(chat_id, 0))
+            bucket = self.__chats.get(chat_id)
+            if bucket is not None:
+                start = bucket.available(start)
+            return self.__throttle(chat_id, start - now)
+
+    def reserve(self, chat_id):
+        """Reserve a call to `chat_id` and return the seconds to wait."""
+        with self.__lock:
+            now = time()
+            bucket = self.__chats.get(chat_id)
+            if bucket is None:
+                bucket = TokenBucket(self.__chat_rate, self.__chat_burst)
+                self.__chats[chat_id] = bucket
+            start = bucket.reserve(max(now, self.__paused.get(chat_id, 0)))
+            # The global limit only counts from now, a call held back for
+            # its chat must not hold back calls to other chats
+            start = max(start, self.__global.reserve(now))
+            return self.__throttle(chat_id, start - now)
+
+    def __throttle(self, chat_id, wait):
+        if wait > 0:
+            self.throttled_calls += 1
+            self.throttled_seconds += wait
+            log.debug("Throttling call to chat {} for {:.2f}s."
+                      .format(chat_id, wait))
+        return wait
+
+    def pause(self, chat_id, seconds):
+        """Hold back all calls to `chat_id` for the next `seconds`."""
+        with self.__lock:
+            until = time() + seconds
+            if until > self.__paused.get(chat_id, 0):
+                self.__paused[chat_id] = until
+            self.flood_waits += 1
+        log.warning("Telegram asked to retry chat {} after {}s."
+                    .format(chat_id, seconds))
+
+    def stats(self):
+        with self.__lock:
+            now = time()
+            return {
+                'throttled_calls': self.throttled_calls,
+                'throttled_seconds': round(self.throttled_seconds, 3),
+                'flood_waits': self.flood_waits,
+                'paused_chats': len([c for c in self.__paused
+                                     if self.__paused[c] > now])
+            }
@@ -0,0 +1,78 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+from collections import namedtuple
+
+# Fields of a raid webhook message TeleRaid needs to restore a raid
+RAID_FIELDS = ('gym_id', 'level', 'pokemon_id', 'move_1', 'move_2', 'start',
+               'end', 'latitude', 'longitude')
+
+# IDs of the sticker, location and text message notifying a chat. Single
+# message notifications are tracked by a 1-tuple of their message ID, so
+# the poll message is always the last ID.
+SentIds = namedtuple('SentIds', ('sticker_id', 'location_id', 'message_id'))
+
+
+class Raid(object):
+    """A tracked raid, without the webhook fields TeleRaid never reads.
+
+    `trace` is the Trace of the webhook event that added the raid, kept
+    until the raid is notified.
+    """
+
+    __slots__ = RAID_FIELDS + ('notified', 'trace')
+
+    def __init__(self, gym_id, level, pokemon_id, move_1, move_2, start, end,
+                 latitude, longitude, notified=False):
+        self.gym_id = gym_id
+        self.level = level
+        self.pokemon_id = pokemon_id
+        self.move_1 = move_1
+        self.move_2 = move_2
+        self.start = start
+        self.end = end
+        self.latitude = latitude
+        self.longitude = longitude
+        self.notified = notified
+        self.trace = None
+
+    @classmethod
+    def from_webhook(cls, message):
+        return cls(*[message.get(f) for f in RAID_FIELDS])
+
+    def values(self):
+        return tuple(getattr(self, f) for f in RAID_FIELDS)
+
+
+class Message(object):
+    """A message with a poll, sent for a raid or only known from votes.
+
+    `body` is None for raid messages, which render it from their raid when
+    needed. `ids` is None for poll-only messages, see SentIds otherwise.
+    `votes` maps user IDs to (username, data) tuples and is only created
+    with the first vote.
+    """
+
+    __slots__ = ('gym_id', 'body', 'ids', 'votes', 'rendered')
+
+    def __init__(self, gym_id='', body=None, ids=None):
+        self.gym_id = gym_id
+        self.body = body
+        self.ids = ids
+        self.votes = None
+        self.rendered = None
+
+    def vote(self, user_id, username, data):
+        if self.votes is None:
+            self.votes = {}
+        self.votes[user_id] = (username, data)
+
+    def tally(self):
+        """Returns the number of yes and no votes."""
+        yes = no = 0
+        for username, data in (self.votes or {}).values():
+            if data == 'y':
+                yes += 1
+            elif data == 'n':
+                no += 1
+        return yes, no
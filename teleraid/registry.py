@@ -0,0 +1,92 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import glob
+import json
+import os
+
+from static.stickers import stickers
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'static')
+
+
+def native_str(text):
+    # Python 2 code around here works on utf-8 encoded byte strings
+    if str is bytes and not isinstance(text, str):
+        return text.encode('utf-8')
+    return text
+
+
+def _load_json(file_path):
+    with open(file_path, 'r') as f:
+        return json.loads(f.read())
+
+
+def _id_table(data, value):
+    table = [None] * (max([int(k) for k in data] or [0]) + 1)
+    for k in data:
+        table[int(k)] = value(data[k])
+    return table
+
+
+class StaticData(object):
+    """Pokemon, move and sticker lookups built once from the static files.
+
+    Names are kept in lists indexed by their ID, one list per locale, and
+    are already translated and encoded for use in messages.
+    """
+
+    def __init__(self, static_dir=STATIC_DIR):
+        self.translations = {'en': {}}
+        for file_path in glob.glob(os.path.join(static_dir, 'locales',
+                                                '*.json')):
+            locale = os.path.splitext(os.path.basename(file_path))[0]
+            self.translations[locale] = dict(
+                (k, native_str(v)) for k, v in _load_json(file_path).items())
+
+        pokemon = _load_json(os.path.join(static_dir, 'pokemon.json'))
+        moves = {}
+        for file_path in glob.glob(os.path.join(static_dir, 'moves_*.json')):
+            locale = os.path.splitext(os.path.basename(file_path))[0][6:]
+            moves[locale] = _load_json(file_path)
+
+        self.pokemon_names = {}
+        self.move_names = {}
+        for locale in set(self.translations) | set(moves):
+            self.pokemon_names[locale] = _id_table(
+                pokemon, lambda p: self.translate(p['name'], locale))
+            # Moves missing in a locale fall back to their english name
+            localized = dict(moves.get('en', {}))
+            localized.update(moves.get(locale, {}))
+            self.move_names[locale] = _id_table(
+                localized, lambda m: native_str(m['name']))
+
+        self.stickers = _id_table(stickers, lambda s: s)
+
+    def translate(self, word, locale='en'):
+        return self.translations.get(locale, {}).get(word, native_str(word))
+
+    def pokemon_name(self, pokemon_id, locale='en'):
+        return self.__lookup(self.pokemon_names.get(locale) or
+                             self.pokemon_names['en'], pokemon_id)
+
+    def move_name(self, move_id, locale='en'):
+        return self.__lookup(self.move_names.get(locale) or
+                             self.move_names['en'], move_id)
+
+    def sticker(self, pokemon_id):
+        return self.__lookup(self.stickers, pokemon_id)
+
+    @staticmethod
+    def __lookup(table, index):
+        value = table[index] if 0 <= index < len(table) else None
+        if value is None:
+            raise KeyError(index)
+        return value
+
+
+def get_static_data():
+    if not hasattr(get_static_data, 'data'):
+        get_static_data.data = StaticData()
+    return get_static_data.data
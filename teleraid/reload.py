@@ -0,0 +1,140 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+import os
+import signal
+
+from threading import Event, Thread
+
+log = logging.getLogger(__name__)
+
+# Config keys that take effect without a restart
+RELOADABLE = frozenset(('chat_id', 'chats', 'notify_levels', 'notify_pokemon',
+                        'notify_geofences', 'geofences', 'geofence_file',
+                        'geofence_cell_size', 'locale', 'timezone'))
+
+
+def config_path():
+    """Path of the config file TeleRaid was started with."""
+    import config.config
+    return os.path.splitext(config.config.__file__)[0] + '.py'
+
+
+class ConfigWatcher(object):
+    """Reloads the config file when it changes or when asked to.
+
+    Subscribers get every newly loaded config dict and compile what they
+    need from it in the thread running `check`, away from the threads that
+    use the result. They return a function putting the result into effect,
+    which `apply` calls where the result is used. A config that fails to
+    load leaves the previous one in effect.
+    """
+
+    def __init__(self, path, interval=5):
+        self.__path = path
+        self.__interval = interval
+        self.__callbacks = []
+        self.__requested = Event()
+        self.__mtime = self.__modified()
+        self.__current = self.load()
+
+    def subscribe(self, callback):
+        self.__callbacks.append(callback)
+
+    def request_reload(self, *args):
+        """Reloads the config soon, e.g. when the process got SIGHUP."""
+        self.__requested.set()
+
+    def load(self):
+        with open(self.__path) as f:
+            source = f.read()
+        namespace = {'__file__': self.__path}
+        exec(compile(source, self.__path, 'exec'), namespace)
+        return namespace['config']
+
+    def check(self, force=False):
+        """Reloads the config if the file changed, returns the functions
+        putting it into effect."""
+        mtime = self.__modified()
+        if mtime == self.__mtime and not force:
+            return []
+        self.__mtime = mtime
+        try:
+            config = self.load()
+        except Exception as e:
+            log.error("Config not reloaded, keeping the previous one: {}"
+                      .format(repr(e)))
+            return []
+
+        changed = [key for key in set(config) | set(self.__current)
+                   if key not in RELOADABLE and
+                   config.get(key) != self.__current.get(key)]
+        if changed:
+            log.warning("Changes of {} take effect after a restart."
+                        .format(', '.join(sorted(changed))))
+        self.__current = config
+        swaps = []
+        for callback in self.__callbacks:
+            try:
+                swap = callback(config)
+            except Exception as e:
+                log.exception("Exception while compiling the reloaded "
+                              "config: {}".format(repr(e)))
+                continue
+            if swap is not None:
+                swaps.append(swap)
+        log.info("Config reloaded.")
+        return swaps
+
+    def apply(self, swaps):
+        for swap in swaps:
+            try:
+                swap()
+            except Exception as e:
+                log.exception("Exception while applying the reloaded "
+                              "config: {}".format(repr(e)))
+
+    def run(self, pool=None):
+        """Checks the config every `interval` seconds and when asked to,
+        only when asked to for an interval of 0.
+
+        Configs are checked by the `apply` method of `pool`, e.g. a thread
+        pool, if given, and put into effect in the calling thread.
+        """
+        while True:
+            requested = self.__requested.wait(self.__interval or None)
+            self.__requested.clear()
+            if pool is None:
+                swaps = self.check(force=bool(requested))
+            else:
+                swaps = pool.apply(self.check, (bool(requested),))
+            self.apply(swaps)
+
+    def __modified(self):
+        try:
+            return os.stat(self.__path).st_mtime
+        except OSError:
+            return None
+
+
+def watch_config(callbacks, interval=5):
+    """Reloads the config for `callbacks` on the gevent engine, when the
+    file changes and on SIGHUP.
+
+    Threads are greenlets there, so configs are loaded and compiled in
+    gevent's thread pool, where a large geofence file does not hold up the
+    webhook server and TeleRaid. The results are swapped in on the hub.
+    """
+    import gevent
+
+    watcher = ConfigWatcher(config_path(), interval)
+    for callback in callbacks:
+        watcher.subscribe(callback)
+    if hasattr(signal, 'SIGHUP'):
+        gevent.signal_handler(signal.SIGHUP, watcher.request_reload)
+    t = Thread(target=watcher.run, args=(gevent.get_hub().threadpool,),
+               name='ConfigWatcher')
+    t.daemon = True
+    t.start()
+    return watcher
@@ -0,0 +1,142 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+from .geofence import geofences_from_config
+
+EMPTY = frozenset()
+
+
+class Subscription(object):
+    """A chat and the raids it wants to be notified about.
+
+    `levels`, `pokemon` and `geofences` of None match any raid level, boss
+    or location.
+    """
+
+    def __init__(self, chat_id, levels=None, pokemon=None, locale='en',
+                 timezone=0, geofences=None):
+        self.chat_id = chat_id
+        self.levels = None if levels is None else frozenset(levels)
+        self.pokemon = None if pokemon is None else frozenset(pokemon)
+        self.geofences = None if geofences is None else frozenset(geofences)
+        self.locale = locale
+        self.timezone = timezone
+
+    def __repr__(self):
+        return 'Subscription({!r})'.format(self.chat_id)
+
+
+class Router(object):
+    """Matches raids to subscriptions through inverted indexes.
+
+    Every filter value maps to the set of subscriptions accepting it, with
+    subscriptions that accept anything added to each set. Matching a raid
+    is then an intersection of precomputed sets, independent of the number
+    of subscriptions.
+    """
+
+    def __init__(self, subscriptions):
+        self.subscriptions = tuple(subscriptions)
+        self.__by_chat = dict((str(s.chat_id), s)
+                              for s in self.subscriptions)
+        self.__any_level, self.__by_level = self.__index('levels')
+        self.__any_pokemon, self.__by_pokemon = self.__index('pokemon')
+        self.__any_fence, self.__by_fence = self.__index('geofences')
+        self.uses_geofences = bool(self.__by_fence)
+
+    def __index(self, field):
+        wildcard = frozenset(s for s in self.subscriptions
+                             if getattr(s, field) is None)
+        index = {}
+        for s in self.subscriptions:
+            for value in getattr(s, field) or ():
+                index.setdefault(value, set()).add(s)
+        return wildcard, dict((value, frozenset(subs) | wildcard)
+                              for value, subs in index.items())
+
+    def match(self, raid, fences=()):
+        """Returns the subscriptions that want to be notified of `raid`.
+
+        `fences` are the names of the geofences the raid's gym lies in.
+        """
+        subs = (self.__by_level.get(raid.level, self.__any_level) &
+                self.__by_pokemon.get(raid.pokemon_id, self.__any_pokemon))
+        if subs and self.uses_geofences:
+            located = self.__any_fence
+            for name in fences:
+                located = located | self.__by_fence.get(name, EMPTY)
+            subs = subs & located
+        return list(subs)
+
+    def subscription(self, chat_id):
+        return self.__by_chat.get(str(chat_id))
+
+    def alias(self, chat_id, subscription):
+        # Chats configured by @username are answered with a numeric ID
+        self.__by_chat[str(chat_id)] = subscription
+
+    def adopt_aliases(self, other):
+        """Takes over the aliases of `other` for chats still subscribed."""
+        for chat_id, subscription in list(other.__by_chat.items()):
+            if chat_id != str(subscription.chat_id):
+                own = self.subscription(subscription.chat_id)
+                if own is not None:
+                    self.alias(chat_id, own)
+
+
+class Filters(object):
+    """Subscriptions and geofences compiled from one version of the config.
+
+    A reloaded config is compiled into new Filters that replace the previous
+    ones as a whole, so raids are never matched against a mix of both.
+    `locale` and `timezone` apply to chats without a subscription.
+    """
+
+    def __init__(self, router, geofences, locale='en', timezone=0):
+        self.router = router
+        self.geofences = geofences
+        self.locale = locale
+        self.timezone = timezone
+
+    def match(self, raid):
+        fences = ()
+        if self.router.uses_geofences:
+            fences = self.geofences.classify(raid.gym_id, raid.latitude,
+                                             raid.longitude)
+        return self.router.match(raid, fences)
+
+    def settings(self, chat_id):
+        """Returns locale and timezone of a chat."""
+        subscription = self.router.subscription(chat_id)
+        if subscription:
+            return subscription.locale, subscription.timezone
+        return self.locale, self.timezone
+
+
+def subscriptions_from_config(config):
+    """Reads the configured chats, falling back to the top-level chat.
+
+    Settings missing in a chat are taken from the top-level config.
+    """
+    chats = config.get('chats') or [{'chat_id': config['chat_id']}]
+    return [Subscription(
+        chat_id=chat['chat_id'],
+        levels=chat.get('notify_levels', config.get('notify_levels')),
+        pokemon=chat.get('notify_pokemon', config.get('notify_pokemon')),
+        locale=chat.get('locale', config.get('locale', 'en')),
+        timezone=chat.get('timezone', config.get('timezone', 0)),
+        geofences=chat.get('notify_geofences',
+                           config.get('notify_geofences'))
+    ) for chat in chats]
+
+
+def filters_from_config(config, previous=None):
+    """Compiles the chats and geofences of `config`.
+
+    Chat aliases learned by the `previous` filters are kept.
+    """
+    router = Router(subscriptions_from_config(config))
+    if previous is not None:
+        router.adopt_aliases(previous.router)
+    return Filters(router, geofences_from_config(config),
+                   config.get('locale', 'en'), config.get('timezone', 0))
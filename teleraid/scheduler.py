@@ -0,0 +1,40 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import heapq
+import itertools
+
+from time import time
+
+
+class Scheduler(object):
+    """Min-heap of (due time, event, key) entries.
+
+    Entries are never removed from the heap directly. Callers re-check the
+    state of `key` when an entry fires, so outdated entries just fall
+    through.
+    """
+
+    def __init__(self):
+        self.__heap = []
+        self.__counter = itertools.count()
+
+    def __len__(self):
+        return len(self.__heap)
+
+    def schedule(self, due, event, key):
+        heapq.heappush(self.__heap, (due, next(self.__counter), event, key))
+
+    def timeout(self, now=None):
+        """Seconds until the next entry is due, None if nothing is pending."""
+        if not self.__heap:
+            return None
+        return max(0, self.__heap[0][0] - (now or time()))
+
+    def pop_due(self, now=None):
+        now = now or time()
+        due = []
+        while self.__heap and self.__heap[0][0] <= now:
+            entry = heapq.heappop(self.__heap)
+            due.append((entry[2], entry[3]))
+        return due
@@ -0,0 +1,441 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import hashlib
+import hmac
+import json
+import logging
+import os
+import socket
+import struct
+import subprocess
+import sys
+import zlib
+
+try:
+    import Queue
+    from SocketServer import StreamRequestHandler, TCPServer, ThreadingMixIn
+except ImportError:
+    import queue as Queue
+    from socketserver import StreamRequestHandler, TCPServer, ThreadingMixIn
+
+from math import floor
+from threading import Lock, Thread
+from time import sleep
+from telepot import Bot as TelegramBot
+
+# Custom files and packages
+from config.config import config
+from .ingest import EVENTS, EventQueue
+from .metrics import gauge
+from .reload import watch_config
+from .utils import set_telegram_api_url
+
+log = logging.getLogger(__name__)
+
+# Starts a local shard with the front-end's module search path, so it
+# imports the same config
+WORKER = ('import sys; sys.path[:0] = {!r}; '
+          'from gevent import monkey; monkey.patch_all(); '
+          'from teleraid.shard import serve_shard; '
+          'serve_shard({}, watch_parent=True)')
+
+HEADER = struct.Struct('>I')
+
+
+def write_frame(sock, payload):
+    """Sends `payload` as JSON, prefixed with its length."""
+    data = json.dumps(payload).encode('utf-8')
+    sock.sendall(HEADER.pack(len(data)) + data)
+
+
+def read_frame(rfile):
+    """Returns the next frame of `rfile`, None once the peer closed it."""
+    header = rfile.read(HEADER.size)
+    if len(header) < HEADER.size:
+        return None
+    data = rfile.read(HEADER.unpack(header)[0])
+    return json.loads(data.decode('utf-8'))
+
+
+def shard_addresses(config):
+    """Returns the (host, port) of every shard.
+
+    Shards listen on 'shard_addresses' if set, otherwise they run on this
+    machine on the ports following the webhook port.
+    """
+    addresses = config.get('shard_addresses') or [
+        '127.0.0.1:{}'.format(config['port'] + 1 + i)
+        for i in range(config['shards'])]
+    return [(a.rsplit(':', 1)[0], int(a.rsplit(':', 1)[1]))
+            for a in addresses]
+
+
+class Partitioner(object):
+    """Assigns webhook events and Telegram updates to shards.
+
+    Raids are partitioned by gym or by the grid cell of their gym, so all
+    reports of a raid end up at the shard owning it. Poll buttons carry
+    the index of the shard that sent the message, votes go back there.
+    """
+
+    def __init__(self, shards, by='gym', cell_size=0.1):
+        self.shards = shards
+        self.__by_cell = by == 'cell'
+        self.__cell_size = float(cell_size)
+
+    def __index(self, key):
+        return (zlib.crc32(_encode(key)) & 0xffffffff) % self.shards
+
+    def event(self, event):
+        message = event.get('message') or {}
+        if self.__by_cell:
+            try:
+                return self.__index(u'{}:{}'.format(
+                    int(floor(float(message['latitude']) /
+                              self.__cell_size)),
+                    int(floor(float(message['longitude']) /
+                              self.__cell_size))))
+            except (KeyError, TypeError, ValueError):
+                pass
+        return self.__index(message.get('gym_id') or u'')
+
+    def update(self, update):
+        """Returns the shard owning the message voted on and the update
+        with the shard index stripped from its callback data."""
+        callback_query = update.get('callback_query') or {}
+        data = callback_query.get('data') or ''
+        vote, _, shard = data.partition(':')
+        if shard.isdigit() and int(shard) < self.shards:
+            callback_query = dict(callback_query, data=vote)
+            return int(shard), dict(update, callback_query=callback_query)
+
+        # Polls sent before sharding was enabled
+        message = callback_query.get('message') or {}
+        return self.__index(u'{}:{}'.format(
+            (message.get('chat') or {}).get('id'),
+            message.get('message_id'))), update
+
+
+class ShardClient(object):
+    """Connection of the front-end to one shard.
+
+    Requests on a connection are answered in order, so concurrent callers
+    take turns. A broken connection is reopened with the next request.
+    """
+
+    def __init__(self, address, secret=None, timeout=10):
+        self.address = address
+        self.__secret = secret
+        self.__timeout = timeout
+        self.__lock = Lock()
+        self.__sock = None
+        self.__rfile = None
+
+    def request(self, payload):
+        with self.__lock:
+            for attempt in range(2):
+                try:
+                    if self.__sock is None:
+                        self.__connect()
+                    write_frame(self.__sock, payload)
+                    reply = read_frame(self.__rfile)
+                    if reply is None:
+                        raise socket.error("Shard closed the connection.")
+                    return reply
+                except (socket.error, ValueError):
+                    self.__close()
+                    if attempt:
+                        raise
+
+    def __connect(self):
+        self.__sock = socket.create_connection(self.address, self.__timeout)
+        self.__sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.__rfile = self.__sock.makefile('rb')
+        if self.__secret:
+            write_frame(self.__sock, {'op': 'hello',
+                                      'secret': self.__secret})
+
+    def __close(self):
+        if self.__sock is not None:
+            try:
+                self.__rfile.close()
+                self.__sock.close()
+            except socket.error:
+                pass
+        self.__sock = self.__rfile = None
+
+
+class ShardedQueue(object):
+    """Stands in for the EventQueue of the webhook route.
+
+    Events are handed to the shards owning them. A batch is only
+    all-or-nothing per shard: if one shard is full or unreachable, the
+    others keep their part, which `accepted` is called with, and the
+    sender's retry of the batch reaches them as duplicates.
+    """
+
+    def __init__(self, clients, partitioner):
+        self.__clients = clients
+        self.__partitioner = partitioner
+        self.accepted = 0
+        self.rejected = 0
+
+    def put_many(self, events, accepted=None):
+        batches = {}
+        for event in events:
+            batches.setdefault(self.__partitioner.event(event), []).append(
+                event)
+
+        full = False
+        for index, batch in batches.items():
+            try:
+                reply = self.__clients[index].request({'op': 'events',
+                                                       'events': batch})
+            except (socket.error, ValueError) as e:
+                log.warning("Shard {} is unreachable: {}".format(index,
+                                                                 repr(e)))
+                reply = {'ok': False}
+            if reply.get('ok'):
+                self.accepted += len(batch)
+                EVENTS.add(len(batch), 'accepted')
+                if accepted is not None:
+                    accepted(batch)
+            else:
+                full = True
+                self.rejected += len(batch)
+                EVENTS.add(len(batch), 'rejected')
+        if full:
+            raise Queue.Full
+
+    def qsize(self):
+        return sum(s['queue']['depth'] for s in shard_stats(self.__clients)
+                   if s)
+
+    def stats(self):
+        return {
+            'depth': self.qsize(),
+            'accepted': self.accepted,
+            'rejected': self.rejected
+        }
+
+
+class ShardedBot(object):
+    """Stands in for TeleRaid in the front-end.
+
+    Receives all Telegram updates of the bot, as only one receiver may
+    poll them, and hands each vote to the shard that sent the poll.
+    """
+
+    def __init__(self, clients, partitioner):
+        self.__bot_token = config['bot_token']
+        if config.get('telegram_api_url'):
+            set_telegram_api_url(config['telegram_api_url'])
+        self.__client = TelegramBot(self.__bot_token)
+        self.__clients = clients
+        self.__partitioner = partitioner
+        self.__webhook_url = config.get('telegram_webhook_url')
+        self.webhook_path = '/telegram/' + config.get(
+            'telegram_webhook_secret',
+            hashlib.sha256(self.__bot_token.encode('utf-8')).hexdigest())
+
+    def run(self):
+        log.info("TeleRaid is running with {} shards..."
+                 .format(len(self.__clients)))
+        if self.__webhook_url and self.__set_webhook():
+            return
+        self.__poll_updates()
+
+    def handle_update(self, update):
+        """Hands over an update received on the Telegram webhook route."""
+        self.__forward([update])
+
+    def stats(self):
+        return {'shards': [s and s['teleraid']
+                           for s in shard_stats(self.__clients)]}
+
+    def __forward(self, updates):
+        batches = {}
+        for update in updates:
+            index, update = self.__partitioner.update(update)
+            batches.setdefault(index, []).append(update)
+        for index, batch in batches.items():
+            try:
+                self.__clients[index].request({'op': 'updates',
+                                               'updates': batch})
+            except (socket.error, ValueError) as e:
+                log.warning("Lost {} updates for unreachable shard {}: {}"
+                            .format(len(batch), index, repr(e)))
+
+    def __set_webhook(self):
+        try:
+            self.__client.setWebhook(
+                url=self.__webhook_url.rstrip('/') + self.webhook_path,
+                allowed_updates=['callback_query'])
+            log.info("Receiving Telegram updates via webhook.")
+            return True
+        except Exception as e:
+            log.exception("Exception while setting webhook, falling back to "
+                          "polling: {}".format(repr(e)))
+            return False
+
+    def __poll_updates(self):
+        offset = None
+        retry_time = 1
+        try:
+            self.__client.deleteWebhook()
+        except Exception as e:
+            log.exception("Exception while deleting webhook: {}"
+                          .format(repr(e)))
+
+        while True:
+            try:
+                # Long polling, shards edit the polls on their own schedule
+                updates = self.__client.getUpdates(
+                    offset=offset, timeout=30,
+                    allowed_updates=['callback_query'])
+                self.__forward(updates)
+                for u in updates:
+                    update_id = u.get('update_id', None)
+                    if update_id and (offset is None or update_id >= offset):
+                        offset = update_id + 1
+                retry_time = 1
+            except Exception as e:
+                log.exception("Exception while receiving updates: {}"
+                              .format(repr(e)))
+                sleep(retry_time)
+                retry_time = min(retry_time * 2, 60)
+
+
+def shard_stats(clients):
+    """Returns the stats of every shard, None for unreachable ones."""
+    stats = []
+    for client in clients:
+        try:
+            stats.append(client.request({'op': 'stats'}))
+        except (socket.error, ValueError):
+            stats.append(None)
+    return stats
+
+
+def start_shards(count):
+    """Starts `count` shards on this machine, ending with this process."""
+    return [subprocess.Popen([sys.executable, '-c',
+                              WORKER.format(sys.path, i)])
+            for i in range(count)]
+
+
+class _Handler(StreamRequestHandler):
+    def handle(self):
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        authorized = not self.server.secret
+        while True:
+            try:
+                frame = read_frame(self.rfile)
+            except ValueError as e:
+                log.warning("Received malformed frame: {}".format(repr(e)))
+                return
+            if frame is None:
+                return
+            if frame.get('op') == 'hello':
+                authorized = hmac.compare_digest(
+                    _encode(frame.get('secret') or u''),
+                    _encode(self.server.secret or u''))
+                continue
+            if not authorized:
+                log.warning("Rejected connection from {} with wrong secret."
+                            .format(self.client_address[0]))
+                return
+            write_frame(self.request, self.server.dispatch(frame))
+
+
+class ShardServer(ThreadingMixIn, TCPServer):
+    """Serves the front-end's requests to a shard."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, queue, raid_bot, secret=None):
+        TCPServer.__init__(self, address, _Handler)
+        self.queue = queue
+        self.raid_bot = raid_bot
+        self.secret = secret
+
+    def dispatch(self, frame):
+        op = frame.get('op')
+        if op == 'events':
+            try:
+                self.queue.put_many(frame['events'])
+            except Queue.Full:
+                log.warning("Queue is full, rejected {} webhook events."
+                            .format(len(frame['events'])))
+                return {'ok': False, 'error': 'full'}
+            return {'ok': True}
+        if op == 'updates':
+            for update in frame['updates']:
+                self.raid_bot.handle_update(update)
+            return {'ok': True}
+        if op == 'stats':
+            return {'ok': True, 'queue': self.queue.stats(),
+                    'teleraid': self.raid_bot.stats()}
+        return {'ok': False, 'error': 'unknown op {}'.format(op)}
+
+
+def serve_shard(index, watch_parent=False):
+    """Runs shard `index` until it is interrupted.
+
+    The shard shares Telegram's rate limits with the others and keeps its
+    raids in a store of its own.
+    """
+    from .teleraid import TeleRaid
+
+    logging.basicConfig(
+        format='%(asctime)s [%(threadName)18s][%(module)14s]'
+        '[%(levelname)8s] shard {}: %(message)s'.format(index))
+    logging.getLogger().setLevel(
+        logging.DEBUG if config.get('debug', False) else logging.INFO)
+
+    addresses = shard_addresses(config)
+    count = len(addresses)
+    config['rate_limit_global'] = config.get('rate_limit_global', 30) / \
+        float(count)
+    config['rate_limit_chat'] = config.get('rate_limit_chat', 20) / \
+        float(count)
+    root, ext = os.path.splitext(config.get('store_path', 'teleraid.db'))
+    config['store_path'] = '{}-shard{}{}'.format(root, index, ext)
+
+    if watch_parent:
+        # Started by a front-end, the shard ends with it
+        t = Thread(target=_exit_with_parent, args=(os.getppid(),),
+                   name='WatchParent')
+        t.daemon = True
+        t.start()
+
+    queue = EventQueue(maxsize=config.get('queue_size', 10000))
+    raid_bot = TeleRaid(queue, shard=index)
+    gauge('teleraid_queue_depth', 'Webhook events waiting in the queue.',
+          queue.qsize)
+    server = ShardServer(addresses[index], queue, raid_bot,
+                         config.get('shard_secret'))
+
+    log.info("TeleRaid shard {} of {} starts.".format(index, count))
+    try:
+        watch_config([raid_bot.reload],
+                     config.get('config_check_interval', 5))
+        t = Thread(target=raid_bot.run, name='TeleRaid')
+        t.daemon = True
+        t.start()
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    log.info("TeleRaid shard {} ended.".format(index))
+
+
+def _exit_with_parent(parent):
+    while os.getppid() == parent:
+        sleep(1)
+    os._exit(0)
+
+
+def _encode(text):
+    return text if isinstance(text, bytes) else text.encode('utf-8')
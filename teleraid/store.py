@@ -0,0 +1,230 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+import sqlite3
+
+try:
+    import Queue
+except ImportError:
+    import queue as Queue
+
+from threading import Thread
+from time import time
+
+from .records import RAID_FIELDS, Raid, SentIds
+
+log = logging.getLogger(__name__)
+
+
+class Store(object):
+    """Keeps nothing, every restart begins with an empty state.
+
+    Stores persist raids, sent messages and poll votes so a restarted
+    TeleRaid neither notifies about known raids again nor loses track of
+    the messages it still has to update and delete.
+    """
+
+    def load(self):
+        """Returns the stored raids, messages and votes.
+
+        Raids are Raid records, messages are (chat_id, message_id, gym_id,
+        ids, body, created) tuples with ids being None for poll-only
+        messages and created the time they were first saved, and votes are
+        (chat_id, message_id, user_id, username, data) tuples.
+        """
+        return [], [], []
+
+    def save_raid(self, raid):
+        pass
+
+    def delete_raid(self, gym_id):
+        pass
+
+    def save_message(self, chat_id, message_id, gym_id, ids, body):
+        pass
+
+    def delete_message(self, chat_id, message_id):
+        pass
+
+    def save_vote(self, chat_id, message_id, user_id, username, data):
+        pass
+
+    def close(self):
+        pass
+
+
+class SQLiteStore(Store):
+    """SQLite database in WAL mode, written by a background thread.
+
+    Changes are queued and committed in batches, so callers never wait for
+    the disk.
+    """
+
+    SCHEMA = (
+        '''CREATE TABLE IF NOT EXISTS raids (
+            gym_id TEXT PRIMARY KEY,
+            level INTEGER,
+            pokemon_id INTEGER,
+            move_1 INTEGER,
+            move_2 INTEGER,
+            start REAL,
+            end REAL,
+            latitude REAL,
+            longitude REAL,
+            notified INTEGER NOT NULL)''',
+        '''CREATE TABLE IF NOT EXISTS messages (
+            chat_id TEXT NOT NULL,
+            message_id INTEGER NOT NULL,
+            gym_id TEXT NOT NULL,
+            sticker_id INTEGER,
+            location_id INTEGER,
+            body TEXT NOT NULL,
+            created REAL,
+            PRIMARY KEY (chat_id, message_id))''',
+        '''CREATE TABLE IF NOT EXISTS votes (
+            chat_id TEXT NOT NULL,
+            message_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            username TEXT,
+            data TEXT,
+            PRIMARY KEY (chat_id, message_id, user_id))'''
+    )
+
+    def __init__(self, path, batch_size=500):
+        self.__path = path
+        self.__batch_size = batch_size
+        self.__ops = Queue.Queue()
+
+        db = self.__connect()
+        for statement in self.SCHEMA:
+            db.execute(statement)
+        columns = [row[1] for row in
+                   db.execute('PRAGMA table_info(messages)')]
+        if 'created' not in columns:
+            # Messages of older databases count as created now
+            db.execute('ALTER TABLE messages ADD COLUMN created REAL')
+            db.execute('UPDATE messages SET created = ?', (time(),))
+        db.commit()
+        db.close()
+
+        t = Thread(target=self.__write, name='SQLiteStore', args=())
+        t.daemon = True
+        t.start()
+
+    def __connect(self):
+        db = sqlite3.connect(self.__path, check_same_thread=False)
+        db.execute('PRAGMA journal_mode=WAL')
+        # In WAL mode this only syncs on checkpoints, not on every commit
+        db.execute('PRAGMA synchronous=NORMAL')
+        return db
+
+    def load(self):
+        db = self.__connect()
+        try:
+            raids = [Raid(*row[:-1], notified=bool(row[-1]))
+                     for row in db.execute(
+                         'SELECT {}, notified FROM raids'.format(
+                             ', '.join(RAID_FIELDS)))]
+            messages = []
+            for row in db.execute(
+                    'SELECT chat_id, message_id, gym_id, sticker_id, '
+                    'location_id, body, created FROM messages'):
+                ids = None
+                if row[2] and row[3] is not None:
+                    ids = SentIds(row[3], row[4], row[1])
+                elif row[2]:
+                    ids = (row[1],)
+                messages.append((_chat_id(row[0]), row[1], row[2], ids,
+                                 row[5], row[6]))
+            votes = [(_chat_id(row[0]),) + row[1:]
+                     for row in db.execute('SELECT chat_id, message_id, '
+                                           'user_id, username, data '
+                                           'FROM votes')]
+        finally:
+            db.close()
+        log.info("Loaded {} raids, {} messages and {} votes from {}."
+                 .format(len(raids), len(messages), len(votes), self.__path))
+        return raids, messages, votes
+
+    def save_raid(self, raid):
+        self.__ops.put((
+            'INSERT OR REPLACE INTO raids VALUES '
+            '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            raid.values() + (int(raid.notified),)))
+
+    def delete_raid(self, gym_id):
+        self.__ops.put(('DELETE FROM raids WHERE gym_id = ?', (gym_id,)))
+
+    def save_message(self, chat_id, message_id, gym_id, ids, body):
+        # Single message notifications have no sticker and location
+        parts = ids if isinstance(ids, SentIds) else (None, None)
+        # Updates of a message keep the time it was created
+        self.__ops.put((
+            'INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?, ?, ?, '
+            'COALESCE((SELECT created FROM messages WHERE chat_id = ? AND '
+            'message_id = ?), ?))',
+            (str(chat_id), message_id, gym_id, parts[0], parts[1],
+             _text(body), str(chat_id), message_id, time())))
+
+    def delete_message(self, chat_id, message_id):
+        self.__ops.put((
+            'DELETE FROM messages WHERE chat_id = ? AND message_id = ?',
+            (str(chat_id), message_id)))
+        self.__ops.put((
+            'DELETE FROM votes WHERE chat_id = ? AND message_id = ?',
+            (str(chat_id), message_id)))
+
+    def save_vote(self, chat_id, message_id, user_id, username, data):
+        self.__ops.put((
+            'INSERT OR REPLACE INTO votes VALUES (?, ?, ?, ?, ?)',
+            (str(chat_id), message_id, user_id, username, data)))
+
+    def close(self):
+        self.__ops.put(None)
+        self.__ops.join()
+
+    def __write(self):
+        db = self.__connect()
+        while True:
+            batch = [self.__ops.get(block=True)]
+            while len(batch) < self.__batch_size and not self.__ops.empty():
+                batch.append(self.__ops.get_nowait())
+
+            try:
+                with db:
+                    for op in batch:
+                        if op is not None:
+                            db.execute(*op)
+            except Exception as e:
+                log.exception("Exception while writing to store: {}"
+                              .format(repr(e)))
+
+            for op in batch:
+                self.__ops.task_done()
+            if None in batch:
+                db.close()
+                return
+
+
+def _chat_id(chat_id):
+    # Chat IDs are stored as text to also allow @channelname
+    try:
+        return int(chat_id)
+    except ValueError:
+        return chat_id
+
+
+def _text(text):
+    # sqlite3 on Python 2 refuses non-ascii byte strings
+    if isinstance(text, bytes):
+        return text.decode('utf-8')
+    return text
+
+
+def get_store(config):
+    stores = {
+        None: lambda: Store(),
+        'sqlite': lambda: SQLiteStore(config.get('store_path', 'teleraid.db'))
+    }
+    return stores[config.get('store', 'sqlite')]()
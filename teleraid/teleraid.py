@@ -3,358 +3,227 @@
 
 import logging
 
-from time import sleep
-from datetime import datetime, timedelta
+try:
+    import Queue
+except ImportError:
+    import queue as Queue
+
+from time import sleep, time
 from threading import Thread
-from gevent import spawn
-from telepot import Bot as TelegramBot
-from telepot.namedtuple import InlineKeyboardMarkup, InlineKeyboardButton
 from telepot.exception import TelegramError
 
 # Custom files and packages
 from config.config import config
-from static.stickers import stickers
-from .utils import telepot_shiny, get_pokemon_name, get_move_name
+from .core import STAGE_SECONDS, TELEGRAM_SECONDS, TeleRaidCore
+from .utils import TelegramBot, set_telegram_api_url
 
 log = logging.getLogger(__name__)
 
 
-class TeleRaid:
-    def __init__(self, queue):
-        self.__bot_token = config['bot_token']
-        self.__chat_id = config['chat_id']
-        self.__client = TelegramBot(self.__bot_token)
-
-        self.__timezone = config.get('timezone', 0)
-        self.__notify_levels = config['notify_levels']
-        self.__notify_pokemon = config['notify_pokemon']
-
+class TeleRaid(TeleRaidCore):
+    def __init__(self, queue, shard=None):
+        super(TeleRaid, self).__init__(shard)
+        # Shards tag their poll buttons and get Telegram updates handed
+        # over by the front-end, which is the only one receiving them
+        self.__shard = shard
+        if config.get('telegram_api_url'):
+            set_telegram_api_url(config['telegram_api_url'])
+        self.__client = TelegramBot(self._bot_token)
         self.__queue = queue
-        self.__raids = {}
-        self.__messages = {}
+        self.__outbox_workers = config.get('notify_workers', 8)
+        self.__updates = Queue.Queue()
 
-        retry_time = 1
-        try:
-            spawn(self.__run())
-            retry_time = 1
-        except Exception as e:
-            log.exception("Exception during runtime spawn: {}".format(repr(e)))
-            retry_time *= 2
-            sleep(retry_time)
-            pass
-
-    def __run(self):
+    def run(self):
         log.info("TeleRaid is running...")
         t = Thread(target=self.__update_messages, name='UpdateMessages',
                    args=())
         t.daemon = True
         t.start()
+        for i in range(self.__outbox_workers):
+            t = Thread(target=self.__send_outbox,
+                       name='Outbox-{}'.format(i), args=())
+            t.daemon = True
+            t.start()
         while True:
             try:
-                data_json = self.__queue.get(block=True)
-                self.__process_request(data_json)
-                self.__update_raids()
-                raids_to_notify = self.__check_raids()
-                for raid in raids_to_notify:
-                    self.__notify(raid)
+                data_json = self.__queue.get(
+                    block=True, timeout=self._scheduler.timeout())
+            except Queue.Empty:
+                data_json = None
+
+            if data_json is not None:
+                try:
+                    with STAGE_SECONDS.time('process_request'):
+                        self._process_request(data_json)
+                except Exception as e:
+                    log.exception("Exception during regular runtime: {}"
+                                  .format(repr(e)))
+                    pass
+
+                self.__queue.task_done()
+
+            try:
+                with STAGE_SECONDS.time('run_scheduled'):
+                    self._run_scheduled()
             except Exception as e:
-                log.exception("Exception during regular runtime: {}"
+                log.exception("Exception while running scheduled events: {}"
                               .format(repr(e)))
                 pass
 
-            self.__queue.task_done()
-
-    def __process_request(self, data_json):
-        if data_json['type'] == 'raid':
-            log.debug("Raid received.")
-            self.__add_raid(data_json['message'])
+    def __send_outbox(self):
+        while True:
+            self._outbox.execute(self._outbox.get())
 
-    def __add_raid(self, raid):
-        if raid['pokemon_id'] and raid['gym_id'] not in self.__raids:
-            raid['notified_battle'] = False
-            self.__raids[raid['gym_id']] = raid
-            log.info("Raid added.")
+    def _send_notification(self, raid, subscription):
+        text, calls = self._notification(raid, subscription)
+        sent = []
+        try:
+            for method, params in calls:
+                sent.append(self.__call(method, subscription.chat_id,
+                                        raid.trace, **params))
+        except Exception:
+            self._notification_failed(sent)
+            raise
+        self._notification_sent(raid, subscription, sent, text)
+
+    def _sweep(self, chat_id):
+        message_ids = self._take_deletions(chat_id)
+        if not message_ids:
+            return
+        try:
+            self.__delete_bulk(chat_id, message_ids)
+        except Exception:
+            self._return_deletions(chat_id, message_ids)
+            raise
 
-    def __update_raids(self):
-        delete_raids = []
-        delete_messages = []
-        for r in self.__raids:
-            if (datetime.utcnow() > datetime.utcfromtimestamp(
-                    self.__raids[r]['end'])):
-                delete_raids.append(r)
-                for m in self.__messages:
-                    if r == self.__messages[m].get('gym_id', ''):
-                        try:
-                            chat_id = self.__chat_id
-                            sticker_id = self.__messages[m]['ids'][
-                                'sticker_id']
-                            location_id = self.__messages[m]['ids'][
-                                'location_id']
-                            message_id = self.__messages[m]['ids'][
-                                'message_id']
-                            self.__delete_message(
-                                msg_identifier=(chat_id, sticker_id))
-                            self.__delete_message(
-                                msg_identifier=(chat_id, location_id))
-                            self.__delete_message(
+    def __delete_bulk(self, chat_id, message_ids):
+        if self._bulk_delete:
+            try:
+                self.__call('deleteMessages', chat_id, chat_id=chat_id,
+                            message_ids=message_ids)
+                log.info("Deleted {} outdated messages."
+                         .format(len(message_ids)))
+                return
+            except TelegramError as e:
+                if not self._bulk_delete_failed(e):
+                    raise
+        for message_id in message_ids:
+            # Deleted already, or too old to be deleted by a bot
+            self.__call_quietly('deleteMessage', chat_id,
+                                "Message not deleted",
                                 msg_identifier=(chat_id, message_id))
-                        except Exception as e:
-                            log.exception("Exception while updating raids: {}"
-                                          .format(repr(e)))
-                            pass
-
-                        delete_messages.append(m)
-                        log.info('Deleted outdated message.')
-
-        for r in delete_raids:
-            del self.__raids[r]
-
-        for m in delete_messages:
-            del self.__messages[m]
+        log.info("Deleted {} outdated messages.".format(len(message_ids)))
+
+    def _edit_poll(self, key):
+        edit = self._poll_edit(key)
+        if edit is None:
+            return
+        message, rendered, method, params = edit
+        if self.__call_quietly(method, key[0],
+                               "No change in message after updating",
+                               **params):
+            message.rendered = rendered
+
+    def handle_update(self, update):
+        """Hands over an update received on the Telegram webhook route."""
+        self.__updates.put(update)
 
-        log.debug("Raids updated.")
-
-    def __check_raids(self):
-        raids_to_notify = []
-        for r in self.__raids:
-            if self.__raids[r]['level'] not in self.__notify_levels:
-                continue
-
-            if self.__raids[r]['pokemon_id'] not in self.__notify_pokemon:
-                continue
-
-            if (datetime.utcnow() > datetime.utcfromtimestamp(
-                    self.__raids[r]['start'])):
-                if not self.__raids[r]['notified_battle']:
-                    log.info("Notifying about raid with Pokemon-ID {}."
-                             .format(self.__raids[r]['pokemon_id']))
-                    raids_to_notify.append(self.__raids[r])
-                else:
-                    log.debug("Already notified about raid of Pokemon-ID {}."
-                              .format(self.__raids[r]['pokemon_id']))
-
-        log.debug("Raids checked.")
-        return raids_to_notify
+    def __update_messages(self):
+        if self.__shard is not None or (self._webhook_url and
+                                        self.__set_webhook()):
+            self.__receive_updates()
+        else:
+            self.__poll_updates()
 
-    def __notify(self, raid):
+    def __set_webhook(self):
         try:
-            # Setup the message
-            raid_end = ((datetime.utcfromtimestamp(raid['end']) +
-                         timedelta(hours=self.__timezone))
-                        .strftime("%H:%M"))
-            raid_pokemon = get_pokemon_name(raid['pokemon_id'])
-            raid_move_1 = get_move_name(raid['move_1'])
-            raid_move_2 = get_move_name(raid['move_2'])
-            text = (
-                       '''
-<b>Raid - Level {} - {}</b>
-{} / {}
-Raid ends at <b>{}</b>.'''
-                       .format(raid['level'], raid_pokemon,
-                               raid_move_1, raid_move_2,
-                               raid_end))
-            inline_keyboard = [[
-                InlineKeyboardButton(text="\xF0\x9F\x91\x8D Yes",
-                                     callback_data='y'),
-                InlineKeyboardButton(text="\xF0\x9F\x91\x8E No",
-                                     callback_data='n')
-            ]]
-            keyboard_markup = InlineKeyboardMarkup(
-                inline_keyboard=inline_keyboard)
-
-            sticker_message = self.__send_sticker(
-                chat_id=self.__chat_id,
-                sticker=stickers[raid['pokemon_id']]
-            )
+            self.__client.setWebhook(
+                url=self._webhook_url.rstrip('/') + self.webhook_path,
+                allowed_updates=['callback_query'])
+            log.info("Receiving Telegram updates via webhook.")
+            return True
+        except Exception as e:
+            log.exception("Exception while setting webhook, falling back to "
+                          "polling: {}".format(repr(e)))
+            return False
 
-            location_message = self.__send_location(
-                chat_id=self.__chat_id,
-                latitude=raid['latitude'],
-                longitude=raid['longitude']
-            )
+    def __receive_updates(self):
+        while True:
+            try:
+                try:
+                    updates = [self.__updates.get(
+                        block=True, timeout=self._poll_edits.timeout())]
+                    while not self.__updates.empty():
+                        updates.append(self.__updates.get_nowait())
+                except Queue.Empty:
+                    updates = []
+
+                self._handle_updates(updates)
+                self._queue_due_edits()
+            except Exception as e:
+                log.exception("Exception while updating messages: {}"
+                              .format(repr(e)))
 
-            message = self.__send_message(text=text,
-                                          chat_id=self.__chat_id,
-                                          parse_mode="HTML",
-                                          reply_markup=keyboard_markup)
-            self.__messages[message['message_id']] = {
-                'gym_id': raid['gym_id'],
-                'text': message['text'],
-                'poll': {
-                    'yes': 0,
-                    'no': 0,
-                    'users': {}
-                },
-                'ids': {
-                    'sticker_id': sticker_message['message_id'],
-                    'location_id': location_message['message_id'],
-                    'message_id': message['message_id']
-                }
-            }
-            raid['notified_battle'] = True
+    def __poll_updates(self):
+        offset = None
+        retry_time = 1
+        try:
+            self.__client.deleteWebhook()
         except Exception as e:
-            log.exception("Exception during notification process: {}"
+            log.exception("Exception while deleting webhook: {}"
                           .format(repr(e)))
-            pass
 
-    def __update_messages(self):
-        offset = None
-        retry_time = 1
         while True:
             try:
                 updates = self.__client.getUpdates(offset=offset)
-                updated_messages = []
+                self._handle_updates(updates)
                 for u in updates:
-                    callback_query = u.get('callback_query', {})
-                    data = callback_query.get('data', None)
-                    message = callback_query.get('message', {})
-                    message_id = message.get('message_id', 0)
-                    if message_id:
-                        updated_messages.append(message_id)
-                        if message_id not in self.__messages:
-                            self.__messages[message_id] = {
-                                'gym_id': '',
-                                'text': message['text'],
-                                'entities': message['entities'],
-                                'poll': {
-                                    'yes': 0,
-                                    'no': 0,
-                                    'users': {}
-                                }
-                            }
-
-                        self.__messages[message_id]['poll']['users'].update({
-                            callback_query['from']['id']: {
-                                'id': callback_query['from']['id'],
-                                'data': data,
-                                'username': callback_query['from']['username']
-                            }
-                        })
-
                     update_id = u.get('update_id', None)
-                    if update_id and update_id >= offset:
+                    if update_id and (offset is None or update_id >= offset):
                         offset = update_id + 1
 
-                for message_id in updated_messages:
-                    poll = self.__messages[message_id]['poll']
-                    poll['yes'] = 0
-                    poll['no'] = 0
-
-                    for user in poll['users']:
-                        if poll['users'][user]['data'] == 'y':
-                            poll['yes'] += 1
-                        elif poll['users'][user]['data'] == 'n':
-                            poll['no'] += 1
-
-                    if poll['yes'] or poll['no']:
-                        text = self.__messages[message_id]['text']
-                        if 'entities' in self.__messages[message_id]:
-                            text = telepot_shiny(self.__messages[message_id])
-
-                        yes_string = ('<b>Yes</b>\n' + '\n'.join(
-                                      [poll['users'][user]['username']
-                                       for user in poll['users']
-                                       if poll['users'][user]['data'] == 'y']))
-                        no_string = ('<b>No</b>\n' + '\n'.join(
-                                     [poll['users'][user]['username']
-                                      for user in poll['users']
-                                      if poll['users'][user]['data'] == 'n']))
-                        text = (text.split('\n\n<b>Yes</b>')[0] + (
-                                '''
-
-{}
-
-{}'''
-                                .format(yes_string, no_string)))
-                        inline_keyboard = [[
-                            InlineKeyboardButton(
-                                text=("\xF0\x9F\x91\x8D Yes ({})"
-                                      .format(poll['yes'])),
-                                callback_data='y'),
-                            InlineKeyboardButton(
-                                text=("\xF0\x9F\x91\x8E No ({})"
-                                      .format(poll['no'])),
-                                callback_data='n')
-                        ]]
-                        keyboard_markup = InlineKeyboardMarkup(
-                            inline_keyboard=inline_keyboard)
-                        message = self.__edit_message(
-                            msg_identifier=(self.__chat_id, message_id),
-                            text=text,
-                            parse_mode='HTML',
-                            reply_markup=keyboard_markup
-                        )
-                        '''message = self.__edit_message_reply_markup(
-                            msg_identifier=(self.__chat_id, message_id),
-                            reply_markup=keyboard_markup
-                        )'''
+                self._queue_due_edits()
 
                 retry_time = 1
             except Exception as e:
                 log.exception("Exception while updating messages: {}"
                               .format(repr(e)))
-                retry_time *= 2
+                retry_time = min(retry_time * 2, 60)
             finally:
                 sleep(retry_time)
 
-    def __send_message(self, text, chat_id,
-                       parse_mode=None, reply_markup=None):
-        try:
-            return self.__client.sendMessage(chat_id=chat_id,
-                                             text=text,
-                                             parse_mode=parse_mode,
-                                             reply_markup=reply_markup)
-        except Exception as e:
-            log.exception("Exception while sending message: {}"
-                          .format(repr(e)))
-
-    def __send_location(self, chat_id, latitude, longitude):
-        try:
-            return self.__client.sendLocation(chat_id=chat_id,
-                                              latitude=latitude,
-                                              longitude=longitude)
-        except Exception as e:
-            log.exception("Exception while sending location: {}"
-                          .format(repr(e)))
-
-    def __send_sticker(self, chat_id, sticker):
-        try:
-            return self.__client.sendSticker(chat_id=chat_id,
-                                             sticker=sticker)
-        except Exception as e:
-            log.exception("Exception while sending sticker: {}"
-                          .format(repr(e)))
-
-    def __edit_message(self, msg_identifier, text,
-                       parse_mode=None, reply_markup=None):
-        try:
-            return self.__client.editMessageText(
-                msg_identifier=msg_identifier,
-                text=text,
-                parse_mode=parse_mode,
-                reply_markup=reply_markup
-            )
-        except TelegramError:
-            log.warning("TelegramError - No change in message after updating.")
-        except Exception as e:
-            log.exception("Exception while editing message: {}"
-                          .format(repr(e)))
-
-    def __edit_message_reply_markup(self, msg_identifier, reply_markup):
-        try:
-            return self.__client.editMessageReplyMarkup(
-                msg_identifier=msg_identifier,
-                reply_markup=reply_markup
-            )
-        except TelegramError:
-            log.warning("TelegramError - No change in message after updating.")
-        except Exception as e:
-            log.exception("Exception while editing keyboard markup: {}"
-                          .format(repr(e)))
+    # Errors of the calls below reach the outbox, which retries the
+    # operation if they are transient
+
+    def __call(self, method, chat, trace=None, **kwargs):
+        # Calls wait for the rate limiter and are retried when Telegram
+        # reports a flood wait, which only pauses the affected chat. Both
+        # end up in the `trace` of a notification.
+        for attempt in range(self._max_flood_retries + 1):
+            requested = time()
+            self._limiter.acquire(chat)
+            start = time()
+            if trace is not None and start - requested > 0.001:
+                trace.add('throttled {}'.format(chat), requested, start)
+            try:
+                return getattr(self.__client, method)(**kwargs)
+            except Exception as e:
+                retry_after = self._flood_wait(method, e, attempt)
+                if retry_after is None:
+                    raise
+                self._limiter.pause(chat, retry_after)
+            finally:
+                TELEGRAM_SECONDS.observe(time() - start, method)
+                if trace is not None:
+                    trace.add('{} {}'.format(method, chat), start)
 
-    def __delete_message(self, msg_identifier):
+    def __call_quietly(self, method, chat, warning, **kwargs):
+        # Telegram rejects edits that change nothing and deletions of gone
+        # messages with 400, which is only logged
         try:
-            return self.__client.deleteMessage(msg_identifier=msg_identifier)
-        except Exception as e:
-            log.exception("Exception while deleting message: {}"
-                          .format(repr(e)))
+            return self.__call(method, chat, **kwargs)
+        except TelegramError as e:
+            if e.error_code != 400:
+                raise
+            log.warning("TelegramError - {}: {}".format(warning,
+                                                        e.description))
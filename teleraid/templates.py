@@ -0,0 +1,109 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+from datetime import datetime, timedelta
+
+from telepot.namedtuple import InlineKeyboardMarkup, InlineKeyboardButton
+
+from .cache import LRUCache
+from .registry import get_static_data, native_str
+from .utils import escape_html
+
+THUMBS_UP = native_str(u'\U0001F44D')
+THUMBS_DOWN = native_str(u'\U0001F44E')
+
+MAP_URL = 'https://maps.google.com/maps?q={},{}'
+
+
+class RaidTemplate(object):
+    """Renders raid notifications and their poll footers.
+
+    The part of a notification that only depends on the raid boss and
+    locale is rendered once and kept in an LRU cache. Poll updates append a
+    freshly rendered footer to the body of the message. `callback_suffix`
+    is appended to the callback data of the poll buttons.
+    """
+
+    def __init__(self, cache_size=512, callback_suffix=''):
+        self.__headers = LRUCache(cache_size)
+        self.__data = get_static_data()
+        self.__suffix = callback_suffix
+
+    def body(self, raid, locale='en', timezone=0):
+        raid_end = ((datetime.utcfromtimestamp(raid.end) +
+                     timedelta(hours=timezone))
+                    .strftime("%H:%M"))
+        key = (raid.pokemon_id, raid.move_1, raid.move_2, raid.level, locale)
+        return self.__headers.get_or_set(
+            key, lambda: self.__header(*key)) + raid_end + '</b>.'
+
+    def map_link(self, raid, locale='en'):
+        """A link to the raid's location, appended to text notifications.
+
+        Telegram previews it as a map below the message.
+        """
+        return '\n<a href="{}">{}</a>'.format(
+            MAP_URL.format(raid.latitude, raid.longitude),
+            self.__data.translate('Open in maps', locale))
+
+    def venue(self, raid, locale='en', timezone=0):
+        """Returns title and address of a venue notifying about `raid`."""
+        raid_end = ((datetime.utcfromtimestamp(raid.end) +
+                     timedelta(hours=timezone))
+                    .strftime("%H:%M"))
+        key = (raid.pokemon_id, raid.move_1, raid.move_2, raid.level, locale,
+               'venue')
+        title, address = self.__headers.get_or_set(
+            key, lambda: self.__venue(*key[:-1]))
+        return title, address + raid_end
+
+    def __venue(self, pokemon_id, move_1, move_2, level, locale):
+        t = self.__data.translate
+        return ('{} - {} {} - {}'.format(
+                    t('Raid', locale), t('Level', locale), level,
+                    self.__data.pokemon_name(pokemon_id, locale)),
+                '{} / {} - {} '.format(
+                    self.__data.move_name(move_1, locale),
+                    self.__data.move_name(move_2, locale),
+                    t('Raid ends at', locale)))
+
+    def __header(self, pokemon_id, move_1, move_2, level, locale):
+        t = self.__data.translate
+        return '''
+<b>{} - {} {} - {}</b>
+{} / {}
+{} <b>'''.format(t('Raid', locale), t('Level', locale), level,
+                 self.__data.pokemon_name(pokemon_id, locale),
+                 self.__data.move_name(move_1, locale),
+                 self.__data.move_name(move_2, locale),
+                 t('Raid ends at', locale))
+
+    def footer(self, votes, locale='en'):
+        t = self.__data.translate
+        votes = list((votes or {}).values())
+        return '''
+
+<b>{}</b>
+{}
+
+<b>{}</b>
+{}'''.format(t('Yes', locale),
+             '\n'.join([escape_html(native_str(username))
+                        for username, data in votes if data == 'y']),
+             t('No', locale),
+             '\n'.join([escape_html(native_str(username))
+                        for username, data in votes if data == 'n']))
+
+    def keyboard(self, tally=None, locale='en'):
+        """Yes and no buttons, with the (yes, no) counts of `tally`."""
+        t = self.__data.translate
+        yes = THUMBS_UP + ' ' + t('Yes', locale)
+        no = THUMBS_DOWN + ' ' + t('No', locale)
+        if tally:
+            yes += ' ({})'.format(tally[0])
+            no += ' ({})'.format(tally[1])
+        return InlineKeyboardMarkup(inline_keyboard=[[
+            InlineKeyboardButton(text=yes,
+                                 callback_data='y' + self.__suffix),
+            InlineKeyboardButton(text=no, callback_data='n' + self.__suffix)
+        ]])
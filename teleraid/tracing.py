@@ -0,0 +1,118 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import cProfile
+import itertools
+import logging
+import pstats
+
+from time import time
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+from .metrics import histogram
+
+log = logging.getLogger(__name__)
+
+EVENT_SECONDS = histogram('teleraid_event_seconds',
+                          'Time from receiving a webhook event until it was '
+                          'handled, by outcome.', ('outcome',))
+
+# Longest profile the admin endpoint captures
+MAX_PROFILE_SECONDS = 300
+
+
+class Trace(object):
+    """Timeline of one webhook event, from the webhook to its last
+    Telegram call.
+
+    Spans are (name, start, end) tuples. `step` records the time since the
+    previous step, for the stages every event passes in order.
+    """
+
+    __slots__ = ('event_id', 'start', 'mark', 'spans')
+
+    def __init__(self, event_id, start):
+        self.event_id = event_id
+        self.start = start
+        self.mark = start
+        self.spans = []
+
+    def add(self, name, start, end=None):
+        self.spans.append((name, start, time() if end is None else end))
+
+    def step(self, name):
+        now = time()
+        self.add(name, self.mark, now)
+        self.mark = now
+
+    def __str__(self):
+        return ', '.join('{} {:.3f}s'.format(name, end - start)
+                         for name, start, end in sorted(
+                             self.spans, key=lambda span: span[1]))
+
+
+class Tracer(object):
+    """Traces webhook events and logs those slower than `slow_seconds`.
+
+    The edge tags events with their ID and arrival time, which travel with
+    them through the queue, or to a shard, where processing resumes the
+    trace. Nothing is traced with `slow_seconds` of None.
+    """
+
+    def __init__(self, slow_seconds=10):
+        self.__slow_seconds = slow_seconds
+        self.__ids = itertools.count(1)
+
+    def tag(self, events):
+        if self.__slow_seconds is None:
+            return
+        now = time()
+        for event in events:
+            event['trace'] = ('{:x}'.format(next(self.__ids)), now)
+
+    def resume(self, tag):
+        """Returns the Trace of a tagged event, None if it is untraced."""
+        if self.__slow_seconds is None or not tag:
+            return None
+        return Trace(tag[0], tag[1])
+
+    def finish(self, trace, outcome):
+        if trace is None:
+            return
+        elapsed = time() - trace.start
+        EVENT_SECONDS.observe(elapsed, outcome)
+        if elapsed >= self.__slow_seconds:
+            log.warning("Slow event {}: {} after {:.2f}s ({}).".format(
+                trace.event_id, outcome, elapsed, trace))
+
+
+class Profiler(object):
+    """cProfile captures of the thread that starts them, one at a time.
+
+    With gevent, all greenlets run in that thread and are captured.
+    """
+
+    def __init__(self):
+        self.__profile = None
+
+    def start(self):
+        """Starts a capture, returns False if one is running already."""
+        if self.__profile is not None:
+            return False
+        self.__profile = cProfile.Profile()
+        self.__profile.enable()
+        return True
+
+    def stop(self, limit=50):
+        """Ends the capture, returns its `limit` most expensive functions
+        as text."""
+        profile, self.__profile = self.__profile, None
+        profile.disable()
+        stream = StringIO()
+        pstats.Stats(profile, stream=stream).sort_stats(
+            'cumulative').print_stats(limit)
+        return stream.getvalue()
@@ -3,71 +3,173 @@
 
 import json
 
+import telepot
+import telepot.api
+
 from config.config import config
+from .registry import get_static_data
+
+
+ENTITY_TAGS = {
+    'bold': ('<b>', '</b>'),
+    'italic': ('<i>', '</i>'),
+    'underline': ('<u>', '</u>'),
+    'strikethrough': ('<s>', '</s>'),
+    'spoiler': ('<tg-spoiler>', '</tg-spoiler>'),
+    'code': ('<code>', '</code>'),
+    'pre': ('<pre>', '</pre>'),
+    'blockquote': ('<blockquote>', '</blockquote>'),
+    'expandable_blockquote': ('<blockquote expandable>', '</blockquote>'),
+    'text_link': (u'<a href="{url}">', '</a>'),
+    'text_mention': (u'<a href="tg://user?id={user[id]}">', '</a>'),
+    'custom_emoji': (u'<tg-emoji emoji-id="{custom_emoji_id}">',
+                     '</tg-emoji>')
+}
+
+
+def escape_html(text, quote=False):
+    text = text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+    if quote:
+        text = text.replace('"', '&quot;')
+    return text
+
+
+def _open_tag(entity):
+    if entity['type'] == 'pre' and entity.get('language'):
+        return u'<pre><code class="language-{}">'.format(
+            escape_html(entity['language'], quote=True))
+    if entity['type'] in ('text_link', 'text_mention', 'custom_emoji'):
+        fields = dict((k, escape_html(v, quote=True) if isinstance(
+            v, type(u'')) else v) for k, v in entity.items())
+        return ENTITY_TAGS[entity['type']][0].format(**fields)
+    return ENTITY_TAGS[entity['type']][0]
+
+
+def _close_tag(entity):
+    if entity['type'] == 'pre' and entity.get('language'):
+        return '</code></pre>'
+    return ENTITY_TAGS[entity['type']][1]
+
+
+def _utf16_indices(text, offsets):
+    # Maps UTF-16 offsets as used by Telegram to indices into `text`
+    if len(text.encode('utf-16-le')) == 2 * len(text):
+        return dict((o, o) for o in offsets)
+
+    indices = {}
+    position = 0
+    for i, c in enumerate(text):
+        if position in offsets:
+            indices[position] = i
+        position += 2 if ord(c) > 0xFFFF else 1
+    indices[position] = len(text)
+    for o in offsets:
+        indices.setdefault(o, len(text))
+    return indices
+
+
+def entities_to_html(text, entities):
+    """Renders Telegram `text` with its `entities` as HTML in one pass.
+
+    Nested entities are rendered as nested tags, overlapping ones are
+    closed and reopened where they cross.
+    """
+    entities = [e for e in entities or [] if e['type'] in ENTITY_TAGS]
+    if not entities:
+        return escape_html(text)
+
+    opens = {}
+    closes = {}
+    for i, e in enumerate(entities):
+        if e['length'] > 0:
+            opens.setdefault(e['offset'], []).append(i)
+            closes.setdefault(e['offset'] + e['length'], []).append(i)
+    positions = sorted(set(opens) | set(closes))
+    indices = _utf16_indices(text, set(positions))
+
+    parts = []
+    stack = []
+    last = 0
+    for position in positions:
+        index = indices[position]
+        if index > last:
+            parts.append(escape_html(text[last:index]))
+            last = index
+
+        if position in closes:
+            # Close everything down to the last ending entity and reopen
+            # the ones that continue
+            ending = closes[position]
+            remaining = len(ending)
+            reopen = []
+            while remaining:
+                i = stack.pop()
+                parts.append(_close_tag(entities[i]))
+                if i in ending:
+                    remaining -= 1
+                else:
+                    reopen.append(i)
+            for i in reversed(reopen):
+                stack.append(i)
+                parts.append(_open_tag(entities[i]))
+
+        if position in opens:
+            starting = opens[position]
+            if len(starting) > 1:
+                starting.sort(key=lambda i: -entities[i]['length'])
+            for i in starting:
+                stack.append(i)
+                parts.append(_open_tag(entities[i]))
+
+    parts.append(escape_html(text[last:]))
+    for i in reversed(stack):
+        parts.append(_close_tag(entities[i]))
+    return ''.join(parts)
 
 
 def telepot_shiny(message):
-    text = message.get('text', '')
-    entities = message.get('entities', [])
-
-    shinies = {
-        'bold': ('<b>', '</b>'),
-        'italic': ('<i>', '</i>')
-    }
-
-    add_off = 0
-    for e in entities:
-        if e['type'] in shinies:
-            text = (text[:add_off + e['offset']] +
-                    shinies[e['type']][0] +
-                    text[add_off+e['offset']:])
-            add_off += len(shinies[e['type']][0])
-
-            text = (text[:add_off+e['offset']+e['length']] +
-                    shinies[e['type']][1] +
-                    text[add_off+e['offset']+e['length']:])
-            add_off += len(shinies[e['type']][1])
-    return text
+    return entities_to_html(message.get('text', ''),
+                            message.get('entities', []))
+
 
+class TelegramBot(telepot.Bot):
+    """telepot's Bot with the Bot API methods telepot predates."""
 
-def i18n(word):
-    locale = config.get('locale', 'en')
-    if locale == "en":
-        return word
+    def deleteMessages(self, chat_id, message_ids):
+        """
+        See: https://core.telegram.org/bots/api#deletemessages
+        """
+        return self._api_request('deleteMessages', {
+            'chat_id': chat_id,
+            'message_ids': json.dumps(list(message_ids))
+        })
 
-    if not hasattr(i18n, 'dictionary'):
-        file_path = 'static/locales/{}.json'.format(locale)
-        with open(file_path, 'r') as f:
-            i18n.dictionary = json.loads(f.read())
 
-    if word in i18n.dictionary:
-        return i18n.dictionary[word]
-    else:
-        return word
+def set_telegram_api_url(url):
+    # Lets telepot talk to another Bot API server, e.g. a local fake one
+    base = url.rstrip('/')
 
+    def methodurl(req, **user_kw):
+        token, method, params, files = req
+        return '{}/bot{}/{}'.format(base, token, method)
 
-def get_pokemon_data(pokemon_id):
-    if not hasattr(get_pokemon_data, 'pokemon'):
-        file_path = "static/pokemon.json"
-        with open(file_path, 'r') as f:
-            get_pokemon_data.pokemon = json.loads(f.read())
+    telepot.api._methodurl = methodurl
 
-    return get_pokemon_data.pokemon[str(pokemon_id)]
 
+def i18n(word, locale=None):
+    return get_static_data().translate(word,
+                                       locale or config.get('locale', 'en'))
 
-def get_pokemon_name(pokemon_id):
-    return i18n(get_pokemon_data(pokemon_id)['name']).encode('utf-8')
 
+def get_pokemon_name(pokemon_id, locale=None):
+    return get_static_data().pokemon_name(
+        pokemon_id, locale or config.get('locale', 'en'))
 
-# Needs i18n support
-def get_moves_data(move_id):
-    if not hasattr(get_moves_data, 'en'):
-        file_path = "static/moves_{}.json".format(config.get('locale', 'en'))
-        with open(file_path, 'r') as f:
-            get_moves_data.moves = json.loads(f.read())
 
-    return get_moves_data.moves[str(move_id)]
+def get_move_name(move_id, locale=None):
+    return get_static_data().move_name(move_id,
+                                       locale or config.get('locale', 'en'))
 
 
-def get_move_name(move_id):
-    return get_moves_data(move_id)['name'].encode('utf-8')
+def get_sticker(pokemon_id):
+    return get_static_data().sticker(pokemon_id)
@@ -0,0 +1,20 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+from threading import Lock
+
+
+class Countdown(object):
+    """Calls `callback` once `count` jobs have called `done`."""
+
+    def __init__(self, count, callback):
+        self.__count = count
+        self.__callback = callback
+        self.__lock = Lock()
+
+    def done(self):
+        with self.__lock:
+            self.__count -= 1
+            finished = self.__count == 0
+        if finished:
+            self.__callback()
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import types
+
+import config
+
+# teleraid reads config/config.py on import, tests without one run with
+# the example config
+try:
+    import config.config  # noqa: F401
+except ImportError:
+    example = os.path.join(os.path.dirname(config.__file__),
+                           'config.example.py')
+    module = types.ModuleType('config.config')
+    module.__file__ = example
+    with open(example) as f:
+        exec(compile(f.read(), example, 'exec'), module.__dict__)
+    sys.modules['config.config'] = config.config = module
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+
+from time import time
+
+from telepot.exception import TelegramError
+
+from teleraid.outbox import DELETE, EDIT, NOTIFY, Outbox
+
+
+def fail():
+    raise IOError("Connection reset")
+
+
+def later():
+    # Past any retry backoff of the tests
+    return time() + 3600
+
+
+def test_put_supersedes_pending_operation():
+    outbox = Outbox()
+    results = []
+    outbox.put(EDIT, ('edit', 1, 2), results.append, 'old',
+               finish=lambda result: results.append(('old', result)))
+    outbox.put(EDIT, ('edit', 1, 2), results.append, 'new',
+               finish=lambda result: results.append(('new', result)))
+    assert results == [('old', 'cancelled')]
+    assert len(outbox) == 1
+
+    op = outbox.pop()
+    assert op.args == ('new',)
+    assert outbox.pop() is None
+    outbox.execute(op)
+    assert results == [('old', 'cancelled'), 'new', ('new', 'done')]
+    assert len(outbox) == 0
+
+
+def test_operations_are_sent_by_priority():
+    outbox = Outbox()
+    for priority in (DELETE, EDIT, NOTIFY):
+        outbox.put(priority, priority, None)
+    assert [outbox.pop().priority for _ in range(3)] == [NOTIFY, EDIT,
+                                                         DELETE]
+
+
+def test_cancel_while_running_finishes_with_outcome():
+    outbox = Outbox()
+    results = []
+    outbox.put(NOTIFY, 'notify', None, finish=results.append)
+    op = outbox.pop()
+
+    outbox.cancel('notify')
+    assert results == []
+    outbox.done(op)
+    assert results == ['done']
+    assert len(outbox) == 0
+
+
+def test_cancelled_while_running_is_not_retried():
+    outbox = Outbox(backoff=0)
+    results = []
+    outbox.put(NOTIFY, 'notify', fail, finish=results.append)
+    op = outbox.pop()
+
+    outbox.cancel('notify')
+    outbox.execute(op)
+    assert results == ['failed']
+    assert outbox.pop(later()) is None
+
+
+def test_superseding_running_operation_keeps_the_new_one():
+    outbox = Outbox()
+    results = []
+    outbox.put(EDIT, 'edit', None,
+               finish=lambda result: results.append(('old', result)))
+    running = outbox.pop()
+    outbox.put(EDIT, 'edit', None,
+               finish=lambda result: results.append(('new', result)))
+
+    outbox.done(running)
+    assert results == [('old', 'done')]
+    assert len(outbox) == 1
+    outbox.done(outbox.pop())
+    assert results == [('old', 'done'), ('new', 'done')]
+
+
+def test_gives_up_after_max_attempts():
+    outbox = Outbox(max_attempts=3, backoff=0)
+    results = []
+    outbox.put(NOTIFY, 'notify', fail, finish=results.append)
+
+    attempts = 0
+    op = outbox.pop()
+    while op is not None:
+        attempts += 1
+        outbox.execute(op)
+        op = outbox.pop(later())
+    assert attempts == 3
+    assert results == ['failed']
+    assert len(outbox) == 0
+
+
+def test_gives_up_on_permanent_error():
+    def bad_request():
+        raise TelegramError("Bad Request: message not found", 400, {})
+
+    outbox = Outbox(backoff=0)
+    results = []
+    outbox.put(EDIT, 'edit', bad_request, finish=results.append)
+    outbox.execute(outbox.pop())
+    assert results == ['failed']
+    assert outbox.pop(later()) is None
+
+
+def test_retries_flood_wait_after_backoff():
+    def flood():
+        raise TelegramError("Too Many Requests: retry after 1", 429, {})
+
+    outbox = Outbox(backoff=10)
+    outbox.put(NOTIFY, 'notify', flood)
+    op = outbox.pop()
+    outbox.execute(op)
+    assert outbox.pop() is None
+    assert 0 < outbox.timeout() <= 15
+    assert outbox.pop(later()) is op
+    assert op.attempts == 1
+
+
+def test_held_operation_waits_in_the_outbox():
+    waits = {'A': 30}
+    outbox = Outbox(hold=lambda op: waits.get(op.chat, 0))
+    outbox.put(NOTIFY, ('notify', 1, 'A'), None, chat='A')
+    outbox.put(EDIT, ('edit', 'B', 2), None, chat='B')
+
+    # Chat B goes first although chat A has the more urgent operation
+    assert outbox.pop().chat == 'B'
+    assert outbox.pop() is None
+    assert 29 < outbox.timeout() <= 30
+    del waits['A']
+    assert outbox.pop(later()).chat == 'A'
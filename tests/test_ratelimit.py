@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+
+from teleraid.ratelimit import RateLimiter, TokenBucket
+
+
+def limiter():
+    return RateLimiter(global_rate=30, global_burst=30,
+                       chat_rate=20 / 60.0, chat_burst=20)
+
+
+def test_bucket_allows_burst_then_rate():
+    bucket = TokenBucket(rate=2, burst=3)
+    assert [bucket.reserve(10.0) for _ in range(4)] == [10.0, 10.0, 10.0,
+                                                        10.5]
+    assert bucket.available(10.0) == 11.0
+
+
+def test_chat_limit():
+    rate_limiter = limiter()
+    assert [rate_limiter.reserve('A') for _ in range(20)] == [0] * 20
+    assert 2.5 < rate_limiter.reserve('A') <= 3
+    assert 5.5 < rate_limiter.delay('A') <= 6
+
+
+def test_global_limit():
+    rate_limiter = limiter()
+    waits = [rate_limiter.reserve(chat) for chat in range(31)]
+    assert waits[:30] == [0] * 30
+    assert 0 < waits[30] <= 1 / 30.0
+
+
+def test_flood_wait_only_pauses_its_chat():
+    rate_limiter = limiter()
+    rate_limiter.pause('A', 30)
+    assert 29 < rate_limiter.delay('A') <= 30
+    assert 29 < rate_limiter.reserve('A') <= 30
+    assert rate_limiter.delay('B') == 0
+    assert rate_limiter.reserve('B') == 0
+    assert rate_limiter.reserve('C') == 0
+    assert rate_limiter.stats()['paused_chats'] == 1
+
+
+def test_throttled_chat_does_not_delay_others():
+    rate_limiter = limiter()
+    for _ in range(25):
+        rate_limiter.reserve('A')
+    assert rate_limiter.delay('A') > 0
+    assert rate_limiter.reserve('B') == 0
+    assert rate_limiter.reserve('C') == 0
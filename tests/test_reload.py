@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+from teleraid.reload import ConfigWatcher
+
+
+def write(path, chat_id):
+    with open(path, 'w') as f:
+        f.write('config = {{"chat_id": {}}}\n'.format(chat_id))
+
+
+def test_reloads_are_applied_where_asked(tmpdir):
+    path = str(tmpdir.join('config.py'))
+    write(path, 1)
+    watcher = ConfigWatcher(path)
+    compiled, applied = [], []
+
+    def reload(config):
+        compiled.append(config['chat_id'])
+        return lambda: applied.append(config['chat_id'])
+    watcher.subscribe(reload)
+
+    assert watcher.check() == []
+    write(path, 2)
+    os.utime(path, (0, 0))
+    swaps = watcher.check()
+    assert compiled == [2] and applied == []
+    watcher.apply(swaps)
+    assert applied == [2]
+
+
+def test_broken_config_keeps_the_previous_one(tmpdir):
+    path = str(tmpdir.join('config.py'))
+    write(path, 1)
+    watcher = ConfigWatcher(path)
+    watcher.subscribe(lambda config: None)
+    with open(path, 'w') as f:
+        f.write('config = {\n')
+    assert watcher.check(force=True) == []
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+
+import sqlite3
+
+from teleraid.store import SQLiteStore
+
+
+def test_messages_keep_the_time_they_were_created(tmpdir):
+    path = str(tmpdir.join('teleraid.db'))
+    store = SQLiteStore(path)
+    store.save_message(-100, 7, '', None, u'Poll')
+    store.close()
+    created = SQLiteStore(path).load()[1][0][5]
+
+    store = SQLiteStore(path)
+    store.save_message(-100, 7, '', None, u'Poll, edited')
+    store.close()
+    messages = SQLiteStore(path).load()[1]
+    assert messages == [(-100, 7, '', None, u'Poll, edited', created)]
+
+
+def test_messages_of_older_databases_get_created(tmpdir):
+    path = str(tmpdir.join('teleraid.db'))
+    db = sqlite3.connect(path)
+    db.execute('''CREATE TABLE messages (
+        chat_id TEXT NOT NULL,
+        message_id INTEGER NOT NULL,
+        gym_id TEXT NOT NULL,
+        sticker_id INTEGER,
+        location_id INTEGER,
+        body TEXT NOT NULL,
+        PRIMARY KEY (chat_id, message_id))''')
+    db.execute("INSERT INTO messages VALUES ('-100', 7, '', NULL, NULL, "
+               "'Poll')")
+    db.commit()
+    db.close()
+
+    messages = SQLiteStore(path).load()[1]
+    assert len(messages) == 1 and messages[0][5] is not None
@@ -0,0 +1,10 @@
+# -*- coding: utf-8 -*-
+
+from teleraid.templates import RaidTemplate
+
+
+def test_footer_escapes_voter_names():
+    votes = {1: (u'<Ash>', 'y'), 2: (u'Misty & Brock', 'n'),
+             3: (u'Gary', 'y')}
+    assert RaidTemplate().footer(votes) == \
+        u'\n\n<b>Yes</b>\n&lt;Ash&gt;\nGary\n\n<b>No</b>\nMisty &amp; Brock'
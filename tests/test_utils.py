@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+from teleraid.utils import entities_to_html
+
+FIRE = u'\U0001F525'
+
+
+def entity(type, offset, length, **fields):
+    fields.update(type=type, offset=offset, length=length)
+    return fields
+
+
+def test_plain_text_is_escaped():
+    assert entities_to_html(u'a < b & c > d', None) == \
+        u'a &lt; b &amp; c &gt; d'
+
+
+def test_text_inside_entities_is_escaped():
+    assert entities_to_html(u'<b>', [entity('bold', 0, 3)]) == \
+        u'<b>&lt;b&gt;</b>'
+
+
+def test_attributes_are_escaped():
+    link = entity('text_link', 0, 3, url=u'https://x.org/?a=1&b="2"')
+    assert entities_to_html(u'map', [link]) == \
+        u'<a href="https://x.org/?a=1&amp;b=&quot;2&quot;">map</a>'
+
+
+def test_offsets_after_emoji_count_utf16_units():
+    # Each emoji outside the BMP takes two UTF-16 code units
+    text = FIRE + FIRE + u' Raid at Park'
+    assert entities_to_html(text, [entity('bold', 5, 4)]) == \
+        FIRE + FIRE + u' <b>Raid</b> at Park'
+
+
+def test_entities_around_emoji():
+    text = FIRE + FIRE + u' Raid'
+    assert entities_to_html(text, [entity('italic', 0, 2),
+                                   entity('bold', 5, 4)]) == \
+        u'<i>' + FIRE + u'</i>' + FIRE + u' <b>Raid</b>'
+    assert entities_to_html(u'Go ' + FIRE, [entity('bold', 3, 2)]) == \
+        u'Go <b>' + FIRE + u'</b>'
+
+
+def test_nested_entities():
+    assert entities_to_html(u'bold italic', [entity('bold', 0, 11),
+                                             entity('italic', 5, 6)]) == \
+        u'<b>bold <i>italic</i></b>'
+
+
+def test_nested_entities_starting_together():
+    # The longer entity encloses the shorter one, whatever their order
+    assert entities_to_html(u'bold italic', [entity('italic', 0, 4),
+                                             entity('bold', 0, 11)]) == \
+        u'<b><i>bold</i> italic</b>'
+
+
+def test_overlapping_entities_are_reopened():
+    assert entities_to_html(u'abcdef', [entity('bold', 0, 4),
+                                        entity('italic', 2, 4)]) == \
+        u'<b>ab<i>cd</i></b><i>ef</i>'
+
+
+def test_pre_with_language():
+    assert entities_to_html(u'x = 1', [entity('pre', 0, 5,
+                                              language='python')]) == \
+        u'<pre><code class="language-python">x = 1</code></pre>'
+
+
+def test_unsupported_and_empty_entities_are_ignored():
+    assert entities_to_html(u'@raids #mewtwo', [entity('mention', 0, 6),
+                                                entity('hashtag', 7, 7),
+                                                entity('bold', 3, 0)]) == \
+        u'@raids #mewtwo'